@@ -0,0 +1,70 @@
+"""Measures how many hits per second each result codec encodes and decodes.
+
+Usage: python benchmarks/bench_codec.py [records]
+"""
+import datetime
+import gc
+import sys
+import time
+
+import mock
+
+from loadsbase import codec
+from loadsbase.codec import get_codec
+
+
+def make_hits(count):
+    started = datetime.datetime.utcnow()
+    return [{'url': u'http://127.0.0.1:9200/%d' % (i % 10),
+             'method': u'GET', 'status': 200, 'started': started,
+             'elapsed': datetime.timedelta(microseconds=1000 + i % 5000),
+             'loads_status': [1, i, 1, 0]} for i in range(count)]
+
+
+def measure(func, *args):
+    best = None
+    for i in range(3):
+        # like timeit, don't let the garbage collector skew the results
+        gc.disable()
+        try:
+            start = time.time()
+            res = func(*args)
+            duration = time.time() - start
+        finally:
+            gc.enable()
+        if best is None or duration < best:
+            best = duration
+    return best, res
+
+
+def bench(label, codec, hits):
+    def encode_each(hits):
+        return [codec.encode(hit) for hit in hits]
+
+    def decode_each(data):
+        return [codec.decode(item) for item in data]
+
+    for mode, encode, decode in (
+            ('each', encode_each, decode_each),
+            ('batch', codec.encode_batch, codec.decode_batch)):
+        encoding, data = measure(encode, hits)
+        decoding = measure(decode, data)[0]
+        size = len(data) if mode == 'batch' else sum(map(len, data))
+        print('%-14s %-6s %10d rec/s encode %10d rec/s decode %8d bytes' % (
+            label, mode, len(hits) / encoding, len(hits) / decoding, size))
+
+
+def main(records=20000):
+    hits = make_hits(records)
+    bench('json', get_codec('json'), hits)
+    bench('binary', get_codec('binary'), hits)
+    if codec.msgpack is not None:
+        with mock.patch.object(codec, 'msgpack', None):
+            bench('binary (pure)', get_codec('binary'), hits)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,217 @@
+"""Measures how a Heartbeat scales with the number of Stethoscopes listening
+to it, over the inproc, ipc and tcp transports.
+
+For each transport and number of subscribers, the heartbeat beats for a
+while and the benchmark reports the distribution of the delivery latency of
+the beats, the rate of beats which never arrived and the CPU time used per
+beat. Everything runs in this process, on a single IO loop, so the CPU
+time covers both sides.
+
+The report is written as JSON. Pass a previous report with --compare to
+print the differences, e.g. between two releases.
+
+Usage: python benchmarks/bench_heartbeat.py [--subscribers 1,10,100]
+           [--transports inproc,ipc,tcp] [--interval 0.05] [--duration 2]
+           [--output report.json] [--compare old-report.json]
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import sys
+import time
+
+import zmq
+try:
+    from zmq.green.eventloop import ioloop
+except ImportError:
+    from zmq.eventloop import ioloop
+
+from loadsbase.heartbeat import Heartbeat, Stethoscope
+from loadsbase.stats import Timer
+
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class BenchHeartbeat(Heartbeat):
+    # counts the beats sent once the measure started
+    measuring = False
+    sent = 0
+
+    def _ping(self):
+        Heartbeat._ping(self)
+        if self.measuring:
+            self.sent += 1
+
+
+class BenchStethoscope(Stethoscope):
+    # records the latency of the beats sent once the measure started
+    def __init__(self, since, latency, *args, **kw):
+        Stethoscope.__init__(self, *args, **kw)
+        self.since = since
+        self.latency = latency
+        self.received = 0
+
+    def _handle_recv(self, msg):
+        received = time.time()
+        sent = float(msg[1])
+        if self.since[0] is not None and sent >= self.since[0]:
+            self.received += 1
+            self.latency.record(received - sent)
+        Stethoscope._handle_recv(self, msg)
+
+
+def get_endpoint(transport):
+    if transport == 'inproc':
+        return 'inproc://loads-beat-bench'
+    elif transport == 'ipc':
+        return 'ipc:///tmp/loads-beat-bench-%d.ipc' % os.getpid()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return 'tcp://127.0.0.1:%d' % port
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(transport, subscribers, interval, duration, warmup=0.5, grace=0.2):
+    loop = ioloop.IOLoop()
+    ctx = zmq.Context()
+    endpoint = get_endpoint(transport)
+    since = [None]
+    latency = Timer('latency')
+    cpu = {}
+
+    hb = BenchHeartbeat(endpoint, interval=interval, io_loop=loop, ctx=ctx)
+    stethos = [BenchStethoscope(since, latency, endpoint, io_loop=loop,
+                                ctx=ctx, warmup_delay=0,
+                                delay=(warmup + duration) * 10)
+               for i in range(subscribers)]
+
+    def start():
+        hb.start()
+        for stetho in stethos:
+            stetho.start()
+
+    def measure():
+        # the subscriptions have been propagated by now
+        since[0] = time.time()
+        hb.measuring = True
+        cpu['start'] = cpu_time()
+
+    def stop_beating():
+        hb.measuring = False
+        hb._cb.stop()
+
+    def stop():
+        cpu['stop'] = cpu_time()
+        for stetho in stethos:
+            stetho.stop()
+        loop.stop()
+
+    loop.add_callback(start)
+    now = time.time()
+    loop.add_timeout(now + warmup, measure)
+    loop.add_timeout(now + warmup + duration, stop_beating)
+    loop.add_timeout(now + warmup + duration + grace, stop)
+    loop.start()
+
+    loop.close(all_fds=False)
+    ctx.destroy(0)
+    if transport == 'ipc' and os.path.exists(endpoint[len('ipc://'):]):
+        os.remove(endpoint[len('ipc://'):])
+
+    expected = hb.sent * subscribers
+    delivered = sum(stetho.received for stetho in stethos)
+    cpu_used = cpu['stop'] - cpu['start']
+    snapshot = latency.snapshot(QUANTILES)
+    return {'transport': transport, 'subscribers': subscribers,
+            'sent': hb.sent, 'expected': expected, 'delivered': delivered,
+            'missed_rate': (1 - float(delivered) / expected
+                            if expected else None),
+            'latency': {'min': snapshot['min'], 'max': snapshot['max'],
+                        'mean': snapshot['mean'],
+                        'quantiles': dict(zip(map(str, QUANTILES),
+                                              snapshot['quantiles']))},
+            'cpu_per_beat': cpu_used / hb.sent if hb.sent else None,
+            'cpu_per_delivery': cpu_used / delivered if delivered else None}
+
+
+def compare(report, previous):
+    def _key(result):
+        return result['transport'], result['subscribers']
+
+    old = dict((_key(result), result) for result in previous['results'])
+    print('\ncompared to %s:' % previous['date'])
+    for result in report['results']:
+        before = old.get(_key(result))
+        if before is None:
+            continue
+        p99 = result['latency']['quantiles']['0.99']
+        old_p99 = before['latency']['quantiles']['0.99']
+        print('%-6s %5d  p99 %+8.3fms  missed %+7.2f%%  cpu/beat %+8.1fus' % (
+            result['transport'], result['subscribers'],
+            ((p99 or 0) - (old_p99 or 0)) * 1000,
+            ((result['missed_rate'] or 0) - (before['missed_rate'] or 0))
+            * 100,
+            ((result['cpu_per_beat'] or 0) - (before['cpu_per_beat'] or 0))
+            * 1e6))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Heartbeat fan-out')
+    parser.add_argument('--subscribers', default='1,10,100',
+                        help='the numbers of stethoscopes, comma-separated')
+    parser.add_argument('--transports', default='inproc,ipc,tcp')
+    parser.add_argument('--interval', type=float, default=0.05,
+                        help='the interval between two beats, in seconds')
+    parser.add_argument('--duration', type=float, default=2.,
+                        help='the duration of each measure, in seconds')
+    parser.add_argument('--output', help='where to write the JSON report')
+    parser.add_argument('--compare', help='a previous report')
+    args = parser.parse_args(args)
+
+    report = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'pyzmq': zmq.pyzmq_version(), 'libzmq': zmq.zmq_version(),
+              'interval': args.interval, 'duration': args.duration,
+              'results': []}
+
+    print('%-6s %5s %6s %8s %9s %9s %9s %11s' % (
+        'trans', 'subs', 'sent', 'missed', 'p50 ms', 'p99 ms', 'max ms',
+        'cpu/beat us'))
+    for transport in args.transports.split(','):
+        for subscribers in map(int, args.subscribers.split(',')):
+            result = run(transport, subscribers, args.interval,
+                         args.duration)
+            report['results'].append(result)
+            quantiles = result['latency']['quantiles']
+            print('%-6s %5d %6d %7.2f%% %9.3f %9.3f %9.3f %11.1f' % (
+                transport, subscribers, result['sent'],
+                (result['missed_rate'] or 0) * 100,
+                (quantiles['0.5'] or 0) * 1000,
+                (quantiles['0.99'] or 0) * 1000,
+                (result['latency']['max'] or 0) * 1000,
+                (result['cpu_per_beat'] or 0) * 1e6))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+    return report
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,41 @@
+"""Measures the time it takes to import a module in a new interpreter,
+which every agent worker pays when it starts.
+
+Usage: python benchmarks/bench_import.py [runs] [module]
+"""
+import subprocess
+import sys
+import time
+
+
+def run(code):
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', code])
+    return time.time() - start
+
+
+def main(runs=20, module='loadsbase.util'):
+    baseline = []
+    imports = []
+    for i in range(runs):
+        baseline.append(run('pass'))
+        imports.append(run('import %s' % module))
+
+    baseline.sort()
+    imports.sort()
+    median = imports[runs // 2] - baseline[runs // 2]
+    best = imports[0] - baseline[0]
+    print('import %s: %.1fms median, %.1fms best, over %d runs' % (
+        module, median * 1000, best * 1000, runs))
+
+    code = ('import sys; before = set(sys.modules); import %s; '
+            'print(len(set(sys.modules) - before))' % module)
+    loaded = subprocess.check_output([sys.executable, '-c', code])
+    print('%d modules loaded' % int(loaded))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args:
+        args[0] = int(args[0])
+    main(*args)
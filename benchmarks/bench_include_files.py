@@ -0,0 +1,66 @@
+"""Compares the ways of packing include files.
+
+Creates a set of text-like and random files, and packs them with the
+behaviour of the previous versions (everything deflated in one thread) and
+with the compression options of write_include_files.
+
+Usage: python benchmarks/bench_include_files.py [files] [file size in KB]
+"""
+from tempfile import mkdtemp
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import time
+
+from loadsbase.util import write_include_files
+
+
+def create_files(location, count, size):
+    words = ['loads', 'agent', 'broker', 'heartbeat', 'latency', 'hits']
+    total = 0
+    for i in range(count):
+        if i % 4 == 0:
+            # already compressed data
+            path = os.path.join(location, 'data%d.gz' % i)
+            data = os.urandom(size)
+        else:
+            path = os.path.join(location, 'data%d.txt' % i)
+            data = ' '.join(random.choice(words)
+                            for j in range(size // 6))[:size]
+        with open(path, 'wb') as f:
+            f.write(data)
+        total += len(data)
+    return total
+
+
+def main(count=40, size=1024):
+    workdir = mkdtemp()
+    try:
+        indir = os.path.join(workdir, 'in')
+        os.makedirs(indir)
+        total = create_files(indir, count, size * 1024)
+        bundle = os.path.join(workdir, 'bundle.zip')
+        workers = multiprocessing.cpu_count()
+
+        modes = [('previous', {'stored_extensions': ()}),
+                 ('stored types', {}),
+                 ('level 1', {'level': 1}),
+                 ('%d workers' % workers, {'workers': workers}),
+                 ('%d workers, level 1' % workers, {'workers': workers,
+                                                    'level': 1})]
+
+        print('%d files, %.1f MB' % (count, total / 1024. / 1024.))
+        for label, options in modes:
+            start = time.time()
+            write_include_files(['*'], bundle, indir, **options)
+            duration = time.time() - start
+            ratio = os.path.getsize(bundle) / float(total)
+            print('%-22s %7.3fs  ratio %.3f' % (label, duration, ratio))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
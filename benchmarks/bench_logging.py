@@ -0,0 +1,73 @@
+"""Measures the cost of a logging call with set_logger, with the handlers
+called synchronously and on a background thread, writing to a file and to
+a slow stream (a terminal or a network filesystem).
+
+Usage: python benchmarks/bench_logging.py [iterations]
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import mock
+
+from loadsbase.util import set_logger
+
+
+class SlowStream(object):
+    def write(self, data):
+        time.sleep(0.0005)
+
+    def flush(self):
+        pass
+
+
+def bench(label, iterations, slow=False, **options):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        name = 'loads.bench.%s' % label.replace(' ', '-')
+        if slow:
+            with mock.patch('sys.stderr', SlowStream()):
+                handler = set_logger(name=name, **options)
+        else:
+            handler = set_logger(name=name,
+                                 logfile=os.path.join(tmpdir, 'loads.log'),
+                                 **options)
+        logger = logging.getLogger(name)
+        logger.propagate = False
+
+        start = time.time()
+        for i in xrange(iterations):
+            logger.info('hit %d on %s', i, 'http://127.0.0.1:9200')
+        duration = time.time() - start
+
+        start = time.time()
+        logger.removeHandler(handler)
+        handler.close()
+        drained = time.time() - start
+    finally:
+        shutil.rmtree(tmpdir)
+
+    dropped = getattr(handler, 'dropped', 0)
+    print('%-22s %8.2f us/call, %6.3fs to drain, %d dropped' % (
+        label, duration / iterations * 1e6, drained, dropped))
+
+
+def main(iterations=100000):
+    bench('file sync', iterations)
+    bench('file background', iterations, background=True,
+          queue_size=iterations)
+    bench('file bounded', iterations, background=True, queue_size=1000)
+
+    iterations = max(iterations / 100, 1)
+    bench('slow stream sync', iterations, slow=True)
+    bench('slow stream background', iterations, slow=True, background=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
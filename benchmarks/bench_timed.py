@@ -0,0 +1,44 @@
+"""Measures the overhead of the loadsbase.util.timed decorator.
+
+Usage: python benchmarks/bench_timed.py [iterations]
+"""
+import sys
+import timeit
+
+from loadsbase.stats import TimerRegistry
+from loadsbase.util import timed
+
+
+def noop():
+    return 1
+
+
+registry = TimerRegistry()
+modes = [('plain', noop),
+         ('timed()', timed()(noop)),
+         ('timed(name=...)', timed(name='noop', registry=registry)(noop))]
+
+
+def main(iterations=1000000):
+    baseline = None
+    for label, func in modes:
+        duration = min(timeit.repeat(func, number=iterations, repeat=3))
+        per_call = duration / iterations * 1e9
+        if baseline is None:
+            baseline = per_call
+            print('%-16s %8.1f ns/call' % (label, per_call))
+        else:
+            print('%-16s %8.1f ns/call (+%.1f ns)' % (label, per_call,
+                                                      per_call - baseline))
+
+    snapshot = registry.snapshot()['noop']
+    print('recorded %d calls, p50=%.2gs p99=%.2gs' % (
+        snapshot['count'], snapshot['quantiles'][0],
+        snapshot['quantiles'][2]))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
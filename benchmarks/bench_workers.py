@@ -0,0 +1,56 @@
+"""Compares the time it takes to get a worker ready by spawning a new
+interpreter, like tests/support.start_process, and by forking a
+loadsbase.workers.WorkerPool, and measures the jobs/second of the pool.
+
+Usage: python benchmarks/bench_workers.py [workers]
+"""
+import subprocess
+import sys
+import time
+
+from loadsbase.workers import WorkerPool
+
+
+def spawn_interpreters(count):
+    # the time until each interpreter has imported loadsbase and exited
+    durations = []
+    with open('/dev/null', 'w') as devnull:
+        for i in range(count):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c',
+                                   'import loadsbase.util, zmq'],
+                                  stdout=devnull, stderr=devnull)
+            durations.append(time.time() - start)
+    return durations
+
+
+def main(workers=8):
+    durations = spawn_interpreters(workers)
+    print('interpreter: %6.1fms per worker' % (
+        sum(durations) / len(durations) * 1000))
+
+    pool = WorkerPool(size=workers)
+    start = time.time()
+    pool.start()
+    started = time.time() - start
+    try:
+        latency = pool.stats()['spawn_latency']
+        print('fork:        %6.1fms per worker (max %.1fms), %.1fms to '
+              'start %d workers' % (latency['mean'] * 1000,
+                                    latency['max'] * 1000, started * 1000,
+                                    workers))
+
+        jobs = 10000
+        start = time.time()
+        pool.map('os.getpid', [()] * jobs)
+        duration = time.time() - start
+        print('jobs:        %6d jobs/s' % (jobs / duration))
+    finally:
+        pool.stop()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,137 @@
+import collections
+import sys
+import time
+
+
+CLOCK_MONOTONIC = 1
+
+
+def _load_clock_gettime():
+    # returns clock_gettime and the timespec structure of ctypes
+    import ctypes
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    # unlike CDLL, PyDLL keeps the GIL during the call, which is cheaper for
+    # a call this short
+    try:
+        # find_library() runs ldconfig, so the usual name is tried first
+        librt = ctypes.PyDLL('librt.so.1')
+    except OSError:
+        import ctypes.util
+        libname = (ctypes.util.find_library('rt') or
+                   ctypes.util.find_library('c'))
+        librt = ctypes.PyDLL(libname)
+    clock_gettime = librt.clock_gettime
+
+    # make sure it works
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec())) != 0:
+        raise OSError('clock_gettime failed')
+    return clock_gettime, timespec
+
+
+def _linux_monotonic():
+    import threading
+
+    # importing ctypes and loading librt are slow, so they happen on the
+    # first call rather than when loadsbase is imported. If they fail, the
+    # clock falls back to time.time().
+    loaded = []
+    lock = threading.Lock()
+
+    # the GIL can be released between the reads of the two fields, so every
+    # thread gets its own preallocated structure
+    local = threading.local()
+
+    def monotonic():
+        try:
+            clock_gettime, ts, ref = local.timespec
+        except AttributeError:
+            with lock:
+                if not loaded:
+                    try:
+                        loaded.append(_load_clock_gettime())
+                    except (ImportError, OSError, AttributeError):
+                        loaded.append(None)
+            if loaded[0] is None:
+                return time.time()
+            import ctypes
+
+            clock_gettime, timespec = loaded[0]
+            ts = timespec()
+            ref = ctypes.byref(ts)
+            local.timespec = clock_gettime, ts, ref
+        if clock_gettime(CLOCK_MONOTONIC, ref) != 0:
+            raise OSError('clock_gettime failed')
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    return monotonic
+
+
+def _get_monotonic():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        from monotonic import monotonic
+        return monotonic
+    except ImportError:
+        pass
+    if sys.platform == 'win32':
+        return time.clock       # pragma: nocover
+    if sys.platform.startswith('linux'):
+        return _linux_monotonic()
+    return time.time            # pragma: nocover
+
+
+# A high-resolution clock that never goes backward and is not affected by
+# system clock updates. Its reference point is undefined, so it should only
+# be used to measure durations.
+monotonic = _get_monotonic()
+
+
+class ClockOffset(object):
+    """Estimates the offset between a remote clock and the local clock.
+
+    Each sample is a timestamp sent by the remote side, associated with the
+    local time at which it was received. Since the transit time is always
+    positive, the difference between the two is a lower bound of the actual
+    offset, and the highest difference seen in the last *window* samples is
+    the best estimate: it corresponds to the fastest transit.
+
+    Options:
+
+    - **window**: the number of samples kept. Defaults to 20.
+    """
+    def __init__(self, window=20):
+        self._samples = collections.deque(maxlen=window)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, remote_time, local_time=None):
+        """Adds a sample. *local_time* defaults to the current time."""
+        if local_time is None:
+            local_time = time.time()
+        self._samples.append(remote_time - local_time)
+
+    @property
+    def offset(self):
+        """The number of seconds to add to a local timestamp to get the
+        remote one, or None if there are no samples yet."""
+        if not self._samples:
+            return None
+        return max(self._samples)
+
+    def to_remote(self, local_time=None):
+        """Converts a local timestamp to the remote timeline.
+
+        *local_time* defaults to the current time. If the offset is unknown
+        the timestamp is returned unchanged.
+        """
+        if local_time is None:
+            local_time = time.time()
+        offset = self.offset
+        if offset is None:
+            return local_time
+        return local_time + offset
@@ -0,0 +1,398 @@
+import datetime
+import json
+import struct
+import threading
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from loadsbase.util import DateTimeJSONEncoder
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# the msgpack extension types
+_DATETIME = 1
+_TIMEDELTA = 2
+_pack_int64 = struct.Struct('>q').pack
+_unpack_int64 = struct.Struct('>q').unpack
+
+
+def _microseconds(td):
+    return (td.days * 86400 + td.seconds) * 1000000 + td.microseconds
+
+
+class Codec(object):
+    """Base class of the codecs used to serialize results.
+
+    A codec has a **name**, and implements :meth:`encode` and
+    :meth:`decode`. :meth:`encode_batch` and :meth:`decode_batch` handle
+    lists of records sharing the same keys, like hits: the keys are only
+    encoded once and each record is encoded as a list of values.
+    """
+    name = None
+
+    def encode(self, obj):
+        raise NotImplementedError()
+
+    def decode(self, data):
+        raise NotImplementedError()
+
+    def encode_batch(self, records):
+        """Encodes a list of mappings which all have the same keys."""
+        if not records:
+            return self.encode([[], []])
+        keys = sorted(records[0])
+        rows = [[record[key] for key in keys] for record in records]
+        return self.encode([keys, rows])
+
+    def decode_batch(self, data):
+        """Decodes data produced by :meth:`encode_batch`."""
+        keys, rows = self.decode(data)
+        return [dict(zip(keys, row)) for row in rows]
+
+
+class JSONCodec(Codec):
+    """Encodes in JSON, like :class:`loadsbase.util.DateTimeJSONEncoder`.
+
+    The datetimes and timedeltas are decoded as strings and floats.
+    """
+    name = 'json'
+
+    def __init__(self):
+        self._encoder = DateTimeJSONEncoder()
+
+    def encode(self, obj):
+        return self._encoder.encode(obj)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class BinaryCodec(Codec):
+    """Encodes in the MessagePack format.
+
+    The datetimes and timedeltas are encoded as extension types, so they are
+    decoded as datetimes and timedeltas. Timezone-aware datetimes are
+    converted to naive UTC ones. str values are encoded as binary data and
+    unicode values as strings.
+
+    The msgpack library is used when installed, otherwise a pure Python
+    implementation producing the same data is used.
+    """
+    name = 'binary'
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def encode(self, obj):
+        if msgpack is not None:
+            # packers are costly to create, so each thread reuses one
+            try:
+                packer = self._local.packer
+            except AttributeError:
+                packer = self._local.packer = msgpack.Packer(
+                    use_bin_type=True, default=self._ext)
+            return packer.pack(obj)
+        out = []
+        self._pack(obj, out)
+        return ''.join(out)
+
+    def decode(self, data):
+        if msgpack is not None:
+            return msgpack.unpackb(data, raw=False, ext_hook=self._from_ext,
+                                   use_list=True)
+        obj, pos = self._unpack(data, 0)
+        if pos != len(data):
+            raise ValueError('Extra data')
+        return obj
+
+    def _ext_data(self, obj):
+        # returns the extension type and data of a datetime or timedelta
+        if isinstance(obj, datetime.datetime):
+            if obj.tzinfo is not None:
+                obj = obj.replace(tzinfo=None) - obj.utcoffset()
+            return _DATETIME, _pack_int64(_microseconds(obj - _EPOCH))
+        elif isinstance(obj, datetime.timedelta):
+            return _TIMEDELTA, _pack_int64(_microseconds(obj))
+        raise TypeError('%r is not serializable' % obj)
+
+    def _ext(self, obj):
+        # skips the validation done by ExtType(), which costs more than
+        # encoding the value
+        return tuple.__new__(msgpack.ExtType, self._ext_data(obj))
+
+    def _from_ext(self, code, data):
+        value = _unpack_int64(data)[0]
+        if code == _DATETIME:
+            return _EPOCH + datetime.timedelta(microseconds=value)
+        elif code == _TIMEDELTA:
+            return datetime.timedelta(microseconds=value)
+        raise ValueError('Unknown extension type %d' % code)
+
+    # pure Python implementation
+
+    # (limit, format) of the headers of the integers, and of the binaries,
+    # strings, arrays and maps, given their size
+    _ints = ((0x100, '>BB', 0xcc), (0x10000, '>BH', 0xcd),
+             (0x100000000, '>BI', 0xce), (0x10000000000000000, '>BQ', 0xcf))
+    _negative_ints = ((-0x80, '>Bb', 0xd0), (-0x8000, '>Bh', 0xd1),
+                      (-0x80000000, '>Bi', 0xd2),
+                      (-0x8000000000000000, '>Bq', 0xd3))
+    _headers = {
+        'bin': ((0x100, '>BB', 0xc4), (0x10000, '>BH', 0xc5),
+                (0x100000000, '>BI', 0xc6)),
+        'str': ((32, '>B', 0xa0), (0x100, '>BB', 0xd9),
+                (0x10000, '>BH', 0xda), (0x100000000, '>BI', 0xdb)),
+        'array': ((16, '>B', 0x90), (0x10000, '>BH', 0xdc),
+                  (0x100000000, '>BI', 0xdd)),
+        'map': ((16, '>B', 0x80), (0x10000, '>BH', 0xde),
+                (0x100000000, '>BI', 0xdf))}
+
+    def _pack_header(self, kind, size, out):
+        for limit, fmt, code in self._headers[kind]:
+            if size < limit:
+                if fmt == '>B':
+                    out.append(chr(code | size))
+                else:
+                    out.append(struct.pack(fmt, code, size))
+                return
+        raise OverflowError('Too big')
+
+    def _pack(self, obj, out):
+        if obj is None:
+            out.append('\xc0')
+        elif obj is False:
+            out.append('\xc2')
+        elif obj is True:
+            out.append('\xc3')
+        elif isinstance(obj, (int, long)):
+            if 0 <= obj < 0x80:
+                out.append(chr(obj))
+            elif -32 <= obj < 0:
+                out.append(chr(obj + 0x100))
+            else:
+                for limit, fmt, code in (self._ints if obj >= 0
+                                         else self._negative_ints):
+                    if (obj < limit) if obj >= 0 else (obj >= limit):
+                        out.append(struct.pack(fmt, code, obj))
+                        break
+                else:
+                    raise OverflowError('Integer too big')
+        elif isinstance(obj, float):
+            out.append(struct.pack('>Bd', 0xcb, obj))
+        elif isinstance(obj, str):
+            self._pack_header('bin', len(obj), out)
+            out.append(obj)
+        elif isinstance(obj, unicode):
+            obj = obj.encode('utf8')
+            self._pack_header('str', len(obj), out)
+            out.append(obj)
+        elif isinstance(obj, (list, tuple)):
+            self._pack_header('array', len(obj), out)
+            for item in obj:
+                self._pack(item, out)
+        elif isinstance(obj, dict):
+            self._pack_header('map', len(obj), out)
+            for key, value in obj.items():
+                self._pack(key, out)
+                self._pack(value, out)
+        else:
+            code, data = self._ext_data(obj)
+            out.append(struct.pack('>BB', 0xd7, code))
+            out.append(data)
+
+    _sizes = {0xc4: '>B', 0xc5: '>H', 0xc6: '>I', 0xd9: '>B', 0xda: '>H',
+              0xdb: '>I', 0xdc: '>H', 0xdd: '>I', 0xde: '>H', 0xdf: '>I'}
+    _numbers = {0xca: '>f', 0xcb: '>d', 0xcc: '>B', 0xcd: '>H', 0xce: '>I',
+                0xcf: '>Q', 0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q'}
+    _kinds = {0xc5: 0xc4, 0xc6: 0xc4, 0xda: 0xd9, 0xdb: 0xd9, 0xdd: 0xdc,
+              0xdf: 0xde}
+    _fixext = {0xd4: 1, 0xd5: 2, 0xd6: 4, 0xd7: 8, 0xd8: 16}
+
+    def _unpack(self, data, pos):
+        code = ord(data[pos])
+        pos += 1
+
+        if code < 0x80:
+            return code, pos
+        elif code >= 0xe0:
+            return code - 0x100, pos
+        elif code == 0xc0:
+            return None, pos
+        elif code == 0xc2:
+            return False, pos
+        elif code == 0xc3:
+            return True, pos
+        elif code in self._numbers:
+            fmt = self._numbers[code]
+            size = struct.calcsize(fmt)
+            return struct.unpack(fmt, data[pos:pos + size])[0], pos + size
+
+        if 0xa0 <= code < 0xc0:
+            kind, size = 0xd9, code & 0x1f
+        elif 0x90 <= code < 0xa0:
+            kind, size = 0xdc, code & 0x0f
+        elif 0x80 <= code < 0x90:
+            kind, size = 0xde, code & 0x0f
+        elif code in self._sizes:
+            fmt = self._sizes[code]
+            length = struct.calcsize(fmt)
+            size = struct.unpack(fmt, data[pos:pos + length])[0]
+            pos += length
+            kind = self._kinds.get(code, code)
+        elif code in self._fixext:
+            ext = ord(data[pos])
+            pos += 1
+            size = self._fixext[code]
+            value = self._from_ext(ext, data[pos:pos + size])
+            return value, pos + size
+        else:
+            raise ValueError('Unsupported type 0x%x' % code)
+
+        if kind == 0xc4:
+            return data[pos:pos + size], pos + size
+        elif kind == 0xd9:
+            return data[pos:pos + size].decode('utf8'), pos + size
+        elif kind == 0xdc:
+            res = []
+            for i in xrange(size):
+                item, pos = self._unpack(data, pos)
+                res.append(item)
+            return res, pos
+        else:
+            res = {}
+            for i in xrange(size):
+                key, pos = self._unpack(data, pos)
+                res[key], pos = self._unpack(data, pos)
+            return res, pos
+
+
+class _StreamEncoder(json.JSONEncoder):
+    # datetimes and timedeltas are tagged so the reader can restore them
+    def default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            if obj.tzinfo is not None:
+                obj = obj.replace(tzinfo=None) - obj.utcoffset()
+            return {'__datetime__': obj.isoformat()}
+        elif isinstance(obj, datetime.timedelta):
+            return {'__timedelta__': _microseconds(obj)}
+        return super(_StreamEncoder, self).default(obj)
+
+
+def _stream_object_hook(obj):
+    if len(obj) == 1:
+        if '__datetime__' in obj:
+            value = obj['__datetime__']
+            # isoformat() omits the microseconds when there are none
+            fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else \
+                '%Y-%m-%dT%H:%M:%S'
+            return datetime.datetime.strptime(value, fmt)
+        elif '__timedelta__' in obj:
+            return datetime.timedelta(microseconds=obj['__timedelta__'])
+    return obj
+
+
+class ResultWriter(object):
+    """Writes results to a file as newline-delimited JSON, one per line.
+
+    Each record is written as soon as :meth:`write` is called, so results
+    can be appended as they come without being kept in memory. Datetimes and
+    timedeltas are read back as such by :func:`read_results`; timezone-aware
+    datetimes are converted to naive UTC ones.
+
+    Options:
+
+    - **fileobj**: a file object, or the path of a file to append to.
+    - **flush**: if True, the file is flushed after each record so readers
+      see it right away. Defaults to False.
+    """
+    def __init__(self, fileobj, flush=False):
+        if isinstance(fileobj, basestring):
+            fileobj = open(fileobj, 'a')
+            self._owned = True
+        else:
+            self._owned = False
+        self.fileobj = fileobj
+        self.flush_each = flush
+        self.count = 0
+        self._encode = _StreamEncoder(separators=(',', ':')).encode
+
+    def write(self, record):
+        """Writes one record."""
+        self.fileobj.write(self._encode(record) + '\n')
+        self.count += 1
+        if self.flush_each:
+            self.fileobj.flush()
+
+    def write_many(self, records):
+        """Writes an iterable of records."""
+        lines = [self._encode(record) + '\n' for record in records]
+        self.fileobj.writelines(lines)
+        self.count += len(lines)
+        if self.flush_each:
+            self.fileobj.flush()
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if self._owned:
+            self.fileobj.close()
+        else:
+            self.fileobj.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def read_results(fileobj):
+    """Iterates over the records written by a :class:`ResultWriter`.
+
+    *fileobj* is a file object or a path. The file is read line by line, so
+    the memory used does not depend on its size. Blank lines are skipped, and
+    so is a last line which is incomplete because the writer is still
+    appending to the file.
+    """
+    if isinstance(fileobj, basestring):
+        with open(fileobj) as f:
+            for record in read_results(f):
+                yield record
+        return
+
+    decode = json.JSONDecoder(object_hook=_stream_object_hook).decode
+    for line in fileobj:
+        if not line.strip():
+            continue
+        try:
+            yield decode(line)
+        except ValueError:
+            if line.endswith('\n'):
+                raise
+            # a partially written record, at the end of the file
+            return
+
+
+_CODECS = {}
+
+
+def register_codec(codec):
+    """Registers a :class:`Codec`, under its name."""
+    _CODECS[codec.name] = codec
+
+
+def get_codec(name='json'):
+    """Returns the codec registered under *name*. Defaults to JSON."""
+    try:
+        return _CODECS[name]
+    except KeyError:
+        raise ValueError('Unknown codec %r' % name)
+
+
+register_codec(JSONCodec())
+register_codec(BinaryCodec())
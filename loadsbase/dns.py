@@ -0,0 +1,467 @@
+import contextlib
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+import zlib
+
+from loadsbase.clock import monotonic
+
+
+def gethostbyname(host):
+    """Returns the list of IPv4 addresses of *host*."""
+    return socket.gethostbyname_ex(host)[2]
+
+
+class DNSCache(object):
+    """A bounded cache of DNS resolutions.
+
+    Entries expire after *ttl* seconds, and when the cache is full the least
+    recently used entry is evicted. Failed resolutions are cached too, for
+    *negative_ttl* seconds, so an unknown host does not trigger a blocking
+    DNS query on every request.
+
+    The **hits**, **misses** and **evictions** counters can be used to check
+    the efficiency of the cache.
+
+    Options:
+
+    - **max_size**: the maximum number of hosts. Defaults to 1024.
+    - **ttl**: the lifetime of an entry, in seconds. Defaults to 60.
+    - **negative_ttl**: the lifetime of a failed resolution, in seconds.
+      Defaults to 5.
+    - **resolver**: a callable taking a hostname and returning a list of
+      addresses. Defaults to :func:`gethostbyname`.
+    - **clock**: the callable used to get the current time.
+    """
+    def __init__(self, max_size=1024, ttl=60., negative_ttl=5.,
+                 resolver=None, clock=monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.resolver = resolver
+        self.clock = clock
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # each host maps to a [prev, next, host, entry] link of a circular
+        # list in LRU order, the least recently used host being after the
+        # root. OrderedDict would do the same, but is not in Python 2.6.
+        self._entries = {}
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def _unlink(self, host):
+        link = self._entries.pop(host, None)
+        if link is not None:
+            prev, next_ = link[0], link[1]
+            prev[1] = next_
+            next_[0] = prev
+        return link
+
+    def _append(self, host, entry):
+        root = self._root
+        last = root[0]
+        last[1] = root[0] = self._entries[host] = [last, root, host, entry]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, host):
+        return self._lookup(host, count=False) is not None
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+            self.hits = self.misses = self.evictions = 0
+
+    def _lookup(self, host, count=True):
+        # returns the (expiration, addrs, error) entry of a host, or None
+        with self._lock:
+            link = self._unlink(host)
+            entry = link and link[3]
+            if entry is not None and entry[0] <= self.clock():
+                entry = None
+
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return None
+
+            # moving the entry at the end keeps the list in LRU order
+            self._append(host, entry)
+            if count:
+                self.hits += 1
+            return entry
+
+    def _store(self, host, addrs, error, ttl):
+        with self._lock:
+            self._unlink(host)
+            self._append(host, (self.clock() + ttl, addrs, error))
+            while len(self._entries) > self.max_size:
+                self._unlink(self._root[1][2])
+                self.evictions += 1
+
+    def get(self, host):
+        """Returns the cached addresses of *host*, or None.
+
+        If the last resolution of the host failed, the error is raised again.
+        """
+        entry = self._lookup(host)
+        if entry is None:
+            return None
+        if entry[2] is not None:
+            raise entry[2]
+        return entry[1]
+
+    def set(self, host, addrs, ttl=None):
+        """Caches the addresses of *host*, for *ttl* seconds (defaults to the
+        ttl option)."""
+        if ttl is None:
+            ttl = self.ttl
+        self._store(host, addrs, None, ttl)
+
+    def set_error(self, host, error, ttl=None):
+        """Caches a failed resolution of *host*, for *ttl* seconds (defaults
+        to the negative_ttl option)."""
+        if ttl is None:
+            ttl = self.negative_ttl
+        self._store(host, None, error, ttl)
+
+    def resolve(self, host):
+        """Returns the addresses of *host*, resolving it if needed.
+
+        Raises socket.error if the resolution fails.
+        """
+        addrs = self.get(host)
+        if addrs is not None:
+            return addrs
+        return self._resolve(host)
+
+    def _resolve(self, host):
+        resolver = self.resolver or gethostbyname
+        try:
+            addrs = resolver(host)
+        except socket.error, exc:
+            self.set_error(host, exc)
+            raise
+
+        self.set(host, addrs)
+        return addrs
+
+    def stats(self):
+        """Returns the size of the cache and its counters."""
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class SharedDNSCache(DNSCache):
+    """A :class:`DNSCache` shared by all the processes of a machine.
+
+    On a local miss, the host is looked up in a table stored in the file at
+    *path*, and only resolved if it's not there or expired. Resolutions are
+    serialized per host across processes with file locks, so a host is
+    resolved once per machine and all the processes share the result and
+    its expiration. The local cache still serves the hits, so the file is
+    only read on misses. File locks don't exclude the threads of a process
+    from each other, so each lock is paired with a thread lock.
+
+    This class relies on :mod:`fcntl`, so it is not available on Windows.
+
+    Options are the same as :class:`DNSCache`, plus:
+
+    - **path**: the file holding the shared table. A *path*.lock file is
+      created next to it.
+    - **lock_slots**: the number of locks the hosts are spread on.
+      Defaults to 64.
+    """
+    def __init__(self, path, lock_slots=64, **options):
+        super(SharedDNSCache, self).__init__(**options)
+        self.path = path
+        self.lock_slots = lock_slots
+        self._lockfile = None
+        self._thread_locks = None
+        self._pid = None
+        self._init_lock = threading.Lock()
+
+    def _open(self):
+        # the lock file and the thread locks are per process
+        with self._init_lock:
+            if self._pid != os.getpid():
+                self._lockfile = open(self.path + '.lock', 'a+')
+                self._thread_locks = [threading.Lock()
+                                      for i in range(self.lock_slots + 1)]
+                self._pid = os.getpid()
+
+    @contextlib.contextmanager
+    def _locked(self, slot):
+        # the table is protected by the first byte of the lock file, and
+        # each host by one of the next bytes
+        import fcntl
+
+        if self._pid != os.getpid():
+            self._open()
+        fd = self._lockfile.fileno()
+        with self._thread_locks[slot]:
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, slot)
+            try:
+                yield
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, slot)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _share(self, host, addrs, error, ttl):
+        with self._locked(0):
+            now = time.time()
+            table = self._read()
+            for key, entry in table.items():
+                if entry[0] <= now:
+                    del table[key]
+            table[host] = now + ttl, addrs, error
+            if len(table) > self.max_size:
+                by_expiration = sorted(table, key=lambda key: table[key][0])
+                for key in by_expiration[:len(table) - self.max_size]:
+                    del table[key]
+
+            # the thread lock already serializes the writers of this
+            # process, but a name per thread doesn't rely on it
+            tmp = '%s.%d.%d' % (self.path, os.getpid(),
+                                threading.current_thread().ident)
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(table, f)
+                os.rename(tmp, self.path)
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+
+    def _resolve(self, host):
+        slot = 1 + zlib.crc32(host) % self.lock_slots
+        with self._locked(slot):
+            entry = self._read().get(host)
+            if entry is not None:
+                ttl = entry[0] - time.time()
+                if ttl > 0:
+                    if entry[2] is None:
+                        self.set(host, entry[1], ttl)
+                        return entry[1]
+                    error = socket.gaierror(*entry[2])
+                    self.set_error(host, error, ttl)
+                    raise error
+
+            try:
+                addrs = super(SharedDNSCache, self)._resolve(host)
+            except socket.error, exc:
+                self._share(host, None, exc.args, self.negative_ttl)
+                raise
+
+            self._share(host, addrs, None, self.ttl)
+            return addrs
+
+
+def prefetch(hosts, cache, workers=10):
+    """Resolves *hosts* concurrently and stores the results in *cache*.
+
+    The hosts which are already cached are skipped, the others are resolved
+    by a pool of *workers* threads. Failures are cached as well, see
+    :meth:`DNSCache.set_error`.
+
+    Returns a report mapping containing:
+
+    - **duration**: the total duration of the prefetch, in seconds.
+    - **cached**: the number of hosts which were already cached.
+    - **resolved**: a mapping of the resolution duration of each host.
+    - **failed**: a mapping of the error message of each failed host.
+    """
+    import Queue
+
+    start = monotonic()
+    hosts = set(hosts)
+    todo = Queue.Queue()
+    for host in hosts:
+        if host not in cache:
+            todo.put(host)
+
+    report = {'cached': len(hosts) - todo.qsize(), 'resolved': {},
+              'failed': {}}
+
+    def _worker():
+        while True:
+            try:
+                host = todo.get_nowait()
+            except Queue.Empty:
+                return
+            started = monotonic()
+            try:
+                cache.resolve(host)
+            except socket.error, exc:
+                report['failed'][host] = str(exc)
+            else:
+                report['resolved'][host] = monotonic() - started
+
+    threads = [threading.Thread(target=_worker)
+               for i in range(min(workers, todo.qsize()))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    report['duration'] = monotonic() - start
+    return report
+
+
+class _AddressHealth(object):
+    __slots__ = ('failures', 'last_failure', 'ejected_until', 'latency')
+
+    def __init__(self):
+        self.failures = 0
+        self.last_failure = None
+        self.ejected_until = None
+        self.latency = None
+
+
+class AddressSelector(object):
+    """Picks one of the addresses a hostname resolves to.
+
+    Callers report back how each address behaves with :meth:`report_failure`
+    and :meth:`report_success`. After *max_failures* consecutive failures an
+    address is ejected for *ejection_time* seconds, unless all the addresses
+    of the host are ejected.
+
+    Subclasses implement the strategy in :meth:`choose`. This one picks a
+    random address.
+
+    Options:
+
+    - **max_failures**: the number of consecutive failures before ejecting
+      an address. Defaults to 3.
+    - **ejection_time**: how long an address is ejected, in seconds.
+      Defaults to 30.
+    - **smoothing**: the weight of a new latency in the moving average of an
+      address. Defaults to 0.3.
+    - **clock**: the callable used to get the current time.
+    """
+    def __init__(self, max_failures=3, ejection_time=30., smoothing=0.3,
+                 clock=monotonic):
+        self.max_failures = max_failures
+        self.ejection_time = ejection_time
+        self.smoothing = smoothing
+        self.clock = clock
+        self._health = {}
+
+    def _get_health(self, addr):
+        health = self._health.get(addr)
+        if health is None:
+            health = self._health[addr] = _AddressHealth()
+        return health
+
+    def report_failure(self, addr):
+        """Reports a connection failure to *addr*."""
+        health = self._get_health(addr)
+        health.failures += 1
+        health.last_failure = now = self.clock()
+        if health.failures >= self.max_failures:
+            health.ejected_until = now + self.ejection_time
+
+    def report_success(self, addr, latency=None):
+        """Reports a successful call to *addr*, and optionally its latency in
+        seconds."""
+        health = self._get_health(addr)
+        health.failures = 0
+        health.ejected_until = None
+        if latency is not None:
+            if health.latency is None:
+                health.latency = latency
+            else:
+                health.latency += self.smoothing * (latency - health.latency)
+
+    def is_ejected(self, addr):
+        health = self._health.get(addr)
+        if health is None or health.ejected_until is None:
+            return False
+        return health.ejected_until > self.clock()
+
+    def select(self, host, addrs):
+        """Returns one of the *addrs* of *host*, skipping the ejected ones."""
+        if len(addrs) > 1:
+            available = [addr for addr in addrs if not self.is_ejected(addr)]
+            if available:
+                addrs = available
+        return self.choose(host, addrs)
+
+    def choose(self, host, addrs):
+        import random
+        return random.choice(addrs)
+
+
+class RoundRobinSelector(AddressSelector):
+    """Picks the addresses of each host in turn."""
+    def __init__(self, **options):
+        super(RoundRobinSelector, self).__init__(**options)
+        self._counters = {}
+
+    def choose(self, host, addrs):
+        counter = self._counters.get(host)
+        if counter is None:
+            counter = self._counters.setdefault(host, itertools.count())
+        return addrs[next(counter) % len(addrs)]
+
+
+class LeastFailureSelector(RoundRobinSelector):
+    """Picks the addresses that never failed, or failed the longest time ago.
+
+    Addresses in the same situation are picked in turn.
+    """
+    def choose(self, host, addrs):
+        def _last_failure(addr):
+            health = self._health.get(addr)
+            if health is None or health.last_failure is None:
+                return float('-inf')
+            return health.last_failure
+
+        oldest = min(_last_failure(addr) for addr in addrs)
+        addrs = [addr for addr in addrs if _last_failure(addr) == oldest]
+        return super(LeastFailureSelector, self).choose(host, addrs)
+
+
+class LatencyWeightedSelector(AddressSelector):
+    """Picks the addresses randomly, with a probability inversely
+    proportional to their average latency.
+
+    Addresses without any known latency get the weight of the fastest
+    address, so they get a chance to be measured.
+    """
+    def choose(self, host, addrs):
+        import random
+
+        weights = []
+        for addr in addrs:
+            health = self._health.get(addr)
+            if health is None or not health.latency:
+                weights.append(None)
+            else:
+                weights.append(1. / health.latency)
+
+        known = [weight for weight in weights if weight is not None]
+        default = max(known) if known else 1.
+        weights = [default if weight is None else weight
+                   for weight in weights]
+
+        point = random.random() * sum(weights)
+        for addr, weight in zip(addrs, weights):
+            point -= weight
+            if point < 0:
+                return addr
+        return addrs[-1]
@@ -8,7 +8,8 @@ except ImportError:
     from zmq.eventloop import ioloop, zmqstream
 
 
-from loadsbase.util import logger
+from loadsbase.clock import ClockOffset
+from loadsbase.util import logger, throttled_logger
 
 DEFAULT_HEARTBEAT = "ipc:///tmp/loads-beat.ipc"
 
@@ -32,6 +33,10 @@ class Stethoscope(object):
     - **onbeat**: a callable that will be called when a ping succeeds.
       Defaults to None.
     - **onregister**: a callable that will be called on a register ping.
+
+    The beats carry the time at which the :class:`Heartbeat` sent them, which
+    is used to estimate the offset between the local clock and the clock of
+    the heartbeat server, see :meth:`remote_time`.
     """
     def __init__(self, endpoint=DEFAULT_HEARTBEAT, warmup_delay=.5, delay=30.,
                  retries=3,
@@ -54,6 +59,7 @@ class Stethoscope(object):
         self.tries = 0
         self.onregister = onregister
         self._endpoint = None
+        self.clock_offset = ClockOffset()
 
     def _initialize(self):
         logger.debug('Subscribing to ' + self.endpoint)
@@ -78,12 +84,22 @@ class Stethoscope(object):
 
     def _handle_recv(self, msg):
         self.tries = 0
+        if len(msg) > 1:
+            try:
+                self.clock_offset.add(float(msg[1]))
+            except ValueError:
+                throttled_logger.debug('Invalid beat timestamp %r', msg[1])
         msg = msg[0]
         if msg == 'BEAT' and self.onbeat is not None:
             self.onbeat()
         elif self.onregister is not None:
             self.onregister()
 
+    def remote_time(self, local_time=None):
+        """Converts a local timestamp (defaults to now) to the timeline of the
+        heartbeat server."""
+        return self.clock_offset.to_remote(local_time)
+
     def start(self):
         """Starts the loop"""
         logger.debug('Starting the loop')
@@ -111,7 +127,8 @@ class Stethoscope(object):
 class Heartbeat(object):
     """Class that implements a ZMQ heartbeat server.
 
-    This class sends in a ZMQ socket regular beats.
+    This class sends in a ZMQ socket regular beats. Each beat is made of two
+    frames: its type and the current time.
 
     Options:
 
@@ -151,9 +168,9 @@ class Heartbeat(object):
         if self.current_register == 0:
             if self.onregister is not None:
                 self.onregister()
-            self._endpoint.send('REGISTER')
+            self._endpoint.send_multipart(['REGISTER', repr(time.time())])
         else:
-            self._endpoint.send('BEAT')
+            self._endpoint.send_multipart(['BEAT', repr(time.time())])
 
         self.current_register += 1
         if self.current_register == self.register:
@@ -0,0 +1,130 @@
+import collections
+import copy
+import logging
+import os
+import threading
+
+
+class BackgroundHandler(logging.Handler):
+    """A logging handler which passes the records to other handlers, on a
+    background thread.
+
+    Logging a record only puts it in a bounded queue, so the caller never
+    waits on disk or terminal I/O. When the queue is full the record is
+    dropped and counted in **dropped**; the count is reported by a warning
+    once the queue has room again.
+
+    The queue is drained when the handler is closed, which
+    :func:`logging.shutdown` does at exit. After a fork, the child process
+    starts its own thread on its first record.
+
+    Options:
+
+    - **handlers**: the handlers the records are passed to.
+    - **queue_size**: the maximum number of pending records. Defaults to
+      10000.
+    - **interval**: how often the pending records are handled, in seconds.
+      Defaults to 0.05.
+    """
+    def __init__(self, handlers, queue_size=10000, interval=0.05):
+        logging.Handler.__init__(self)
+        self.handlers = list(handlers)
+        self.queue_size = queue_size
+        self.interval = interval
+        self.dropped = 0
+        self._reported = 0
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _start(self):
+        # appending to a deque needs no lock, and the thread is not woken up
+        # for each record: it handles the pending records every *interval*
+        self._queue = collections.deque()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._pid = os.getpid()
+        self._thread.start()
+
+    def prepare(self, record):
+        # the record is formatted on another thread, so the arguments and
+        # the traceback are rendered now, while they are accurate. The other
+        # handlers of the record get it unchanged.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+    def handle(self, record):
+        # appending to the deque is thread-safe, so unlike the base class,
+        # this does not acquire the handler lock for each record
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self.acquire()
+            try:
+                if self._pid != os.getpid():
+                    self._start()
+            finally:
+                self.release()
+        if len(self._queue) >= self.queue_size:
+            self.dropped += 1
+            return
+        try:
+            self._queue.append(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+    def handle_record(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _run(self):
+        queue = self._queue
+        name = 'loads'
+        while True:
+            # wait() returns None on Python 2.6, whether the event is set
+            # or not
+            self._stop.wait(self.interval)
+            stopping = self._stop.is_set()
+            while queue:
+                record = queue.popleft()
+                self.handle_record(record)
+                name = record.name
+
+            dropped = self.dropped
+            if dropped != self._reported:
+                self.handle_record(logging.makeLogRecord({
+                    'name': name, 'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': '%d log records dropped' % (
+                        dropped - self._reported)}))
+                self._reported = dropped
+
+            if stopping:
+                return
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+    def close(self):
+        """Processes the pending records, then closes the handlers."""
+        if self._thread is not None and self._pid == os.getpid():
+            self._stop.set()
+            self._thread.join()
+        self._thread = self._pid = None
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
@@ -0,0 +1,558 @@
+import math
+import operator
+import struct
+
+from loadsbase.clock import monotonic
+
+
+if hasattr(int, 'bit_length'):
+    _bit_length = operator.methodcaller('bit_length')
+else:
+    # Python 2.6
+    def _bit_length(value):
+        return len(bin(value).lstrip('-0b'))
+
+
+class QuantileSketch(object):
+    """Streaming quantile estimator with a bounded memory footprint.
+
+    Values are counted in logarithmic buckets, so every estimate returned by
+    :meth:`quantiles` is within *relative_accuracy* of an actual value of the
+    data set (0.01 means 1%), no matter how many values were added.
+
+    This is a variant of the DDSketch algorithm, see
+    http://www.vldb.org/pvldb/vol12/p2195-masson.pdf
+
+    Options:
+
+    - **relative_accuracy**: the maximum relative error of an estimate.
+      Defaults to 1%.
+    - **max_bins**: the maximum number of buckets to keep. When reached, the
+      lowest buckets are collapsed together, so only the lowest quantiles
+      lose accuracy. Defaults to 2048, which is enough to cover values from
+      a nanosecond to several days with the default accuracy.
+    - **min_value**: values smaller than this one are counted as zeros.
+    """
+    def __init__(self, relative_accuracy=0.01, max_bins=2048, min_value=1e-9):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('relative_accuracy should be between 0 and 1')
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.min_value = min_value
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    def _key(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _value(self, key):
+        return 2 * self._gamma ** key / (self._gamma + 1)
+
+    def add(self, value, count=1):
+        """Adds *value* to the sketch, *count* times."""
+        if value < 0:
+            raise ValueError('The sketch only accepts positive values')
+
+        if value < self.min_value:
+            self.zero_count += count
+        else:
+            key = self._key(value)
+            bins = self._bins
+            if key in bins:
+                bins[key] += count
+            else:
+                bins[key] = count
+                if len(bins) > self.max_bins:
+                    self._collapse()
+
+        self.count += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def _collapse(self):
+        keys = sorted(self._bins)
+        excess = len(keys) - self.max_bins
+        target = keys[excess]
+        for key in keys[:excess]:
+            self._bins[target] += self._bins.pop(key)
+
+    def merge(self, other):
+        """Adds all the values counted by *other* into this sketch.
+
+        Both sketches must have the same relative accuracy.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Cannot merge sketches of different accuracy')
+        if other.count == 0:
+            return
+
+        bins = self._bins
+        for key, count in other._bins.items():
+            bins[key] = bins.get(key, 0) + count
+        if len(bins) > self.max_bins:
+            self._collapse()
+
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+    def quantiles(self, quantiles):
+        """Returns the estimated values for the given list of quantiles.
+
+        The quantiles are floats between 0 and 1, and the result is a list of
+        the same length, in the same order. All the quantiles are computed in
+        a single pass over the buckets.
+        """
+        if self.count == 0:
+            raise ValueError('The sketch is empty')
+
+        order = sorted(range(len(quantiles)), key=lambda i: quantiles[i])
+        res = [None] * len(quantiles)
+        keys = sorted(self._bins)
+        pos = 0
+        seen = self.zero_count
+
+        for index in order:
+            q = quantiles[index]
+            if not 0 <= q <= 1:
+                raise ValueError('Quantiles should be between 0 and 1')
+            if q == 0:
+                res[index] = self.min
+                continue
+            if q == 1:
+                res[index] = self.max
+                continue
+
+            rank = q * (self.count - 1)
+            if rank < self.zero_count:
+                res[index] = self.min
+                continue
+
+            while seen <= rank:
+                seen += self._bins[keys[pos]]
+                pos += 1
+
+            value = self._value(keys[pos - 1])
+            res[index] = min(max(value, self.min), self.max)
+
+        return res
+
+
+def _write_varint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class Histogram(object):
+    """Latency histogram with a fixed log-linear bucket layout.
+
+    Values are converted to integer ticks of *unit* seconds (1 microsecond by
+    default) and counted in buckets which are linear inside each power of two,
+    in the spirit of HdrHistogram. Every bucket is 2 ** -(significant_bits - 1)
+    wide relatively to its value, so with the default 8 bits estimates are
+    within 0.8% of the recorded values.
+
+    Since the layout only depends on the options, histograms built by
+    different agents with the same options can be merged without any loss
+    with :meth:`merge`, and shipped as compact binary blobs using
+    :meth:`dumps` and :meth:`loads`. The blob is a plain string, so it can be
+    sent as a ZMQ frame like the heartbeat messages.
+
+    Options:
+
+    - **significant_bits**: the number of bits kept for each value.
+      Defaults to 8.
+    - **max_value**: the highest trackable value, in seconds. Bigger values
+      are counted in the last bucket. Defaults to one hour.
+    - **unit**: the size of a tick, in seconds. Defaults to 1e-6.
+    """
+    _magic = 'LHST'
+    _header = struct.Struct('!4sBBdQQddd')
+
+    def __init__(self, significant_bits=8, max_value=3600., unit=1e-6):
+        if not 2 <= significant_bits <= 16:
+            raise ValueError('significant_bits should be between 2 and 16')
+        self.significant_bits = significant_bits
+        self.unit = unit
+        self.max_ticks = int(max_value / unit)
+        self._half = 1 << (significant_bits - 1)
+        self.counts = [0] * (self._index(self.max_ticks) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def max_value(self):
+        return self.max_ticks * self.unit
+
+    def _index(self, ticks):
+        shift = _bit_length(ticks) - self.significant_bits
+        if shift <= 0:
+            return ticks
+        return shift * self._half + (ticks >> shift)
+
+    def _bounds(self, index):
+        if index < 2 * self._half:
+            return index, index + 1
+        shift = index // self._half - 1
+        sub = index - shift * self._half
+        return sub << shift, (sub + 1) << shift
+
+    def _value(self, index):
+        lower, upper = self._bounds(index)
+        return (lower + upper - 1) / 2. * self.unit
+
+    def _same_layout(self, other):
+        return (self.significant_bits == other.significant_bits and
+                self.max_ticks == other.max_ticks and
+                self.unit == other.unit)
+
+    def add(self, value, count=1):
+        """Adds *value* to the histogram, *count* times."""
+        if value < 0:
+            raise ValueError('The histogram only accepts positive values')
+
+        # this is _index(), inlined since add() is called on hot paths. Each
+        # attribute is read once.
+        ticks = int(value / self.unit)
+        max_ticks = self.max_ticks
+        if ticks > max_ticks:
+            ticks = max_ticks
+        shift = _bit_length(ticks) - self.significant_bits
+        if shift > 0:
+            self.counts[shift * self._half + (ticks >> shift)] += count
+        else:
+            self.counts[ticks] += count
+
+        self.count += count
+        self.sum += value * count
+        # a value can't be lower than the minimum and higher than the maximum
+        min_ = self.min
+        if min_ is None:
+            self.min = self.max = value
+        elif value < min_:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Adds all the values counted by *other* into this histogram.
+
+        Both histograms must have been created with the same options.
+        """
+        if not self._same_layout(other):
+            raise ValueError('Cannot merge histograms of different layouts')
+        if other.count == 0:
+            return
+
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+
+        self.count += other.count
+        self.sum += other.sum
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+    def quantiles(self, quantiles):
+        """Returns the estimated values for the given list of quantiles.
+
+        Works like :meth:`QuantileSketch.quantiles`, in O(buckets).
+        """
+        if self.count == 0:
+            raise ValueError('The histogram is empty')
+
+        order = sorted(range(len(quantiles)), key=lambda i: quantiles[i])
+        res = [None] * len(quantiles)
+        counts = self.counts
+        index = 0
+        seen = 0
+
+        for pos in order:
+            q = quantiles[pos]
+            if not 0 <= q <= 1:
+                raise ValueError('Quantiles should be between 0 and 1')
+            if q == 0:
+                res[pos] = self.min
+                continue
+            if q == 1:
+                res[pos] = self.max
+                continue
+
+            rank = q * (self.count - 1)
+            while seen <= rank:
+                seen += counts[index]
+                index += 1
+
+            value = self._value(index - 1)
+            res[pos] = min(max(value, self.min), self.max)
+
+        return res
+
+    def dumps(self):
+        """Serializes the histogram into a compact binary string.
+
+        Only the non-empty buckets are stored, as varint-encoded pairs of
+        (index delta, count).
+        """
+        buf = bytearray(self._header.pack(
+            self._magic, 1, self.significant_bits, self.unit, self.max_ticks,
+            self.count, self.sum, self.min or 0., self.max or 0.))
+
+        last = 0
+        for index, count in enumerate(self.counts):
+            if count:
+                _write_varint(buf, index - last)
+                _write_varint(buf, count)
+                last = index
+
+        return str(buf)
+
+    @classmethod
+    def loads(cls, data):
+        """Builds a histogram from a string produced by :meth:`dumps`.
+
+        Raises ValueError if *data* is not a valid histogram.
+        """
+        header = cls._header
+        try:
+            (magic, version, bits, unit, max_ticks, count, sum_, min_,
+             max_) = header.unpack_from(data)
+        except struct.error:
+            raise ValueError('Invalid histogram data')
+        if magic != cls._magic or version != 1 or not unit > 0:
+            raise ValueError('Invalid histogram data')
+
+        hist = cls(significant_bits=bits, unit=unit)
+        hist.max_ticks = max_ticks
+        hist.counts = [0] * (hist._index(max_ticks) + 1)
+        hist.count = count
+        hist.sum = sum_
+        if count:
+            hist.min = min_
+            hist.max = max_
+
+        data = bytearray(data)
+        counts = hist.counts
+        pos = header.size
+        index = 0
+        try:
+            while pos < len(data):
+                delta, pos = _read_varint(data, pos)
+                index += delta
+                if index >= len(counts):
+                    raise ValueError('Invalid histogram data')
+                counts[index], pos = _read_varint(data, pos)
+        except IndexError:
+            # the data is truncated
+            raise ValueError('Invalid histogram data')
+
+        return hist
+
+
+class RollingWindow(object):
+    """Rolling statistics over the last *size* seconds.
+
+    The window is a ring of time slots of *resolution* seconds, each one
+    holding a count, a sum, a min, a max and a :class:`QuantileSketch` of the
+    values added during that slot. Adding a value is O(1), and reading the
+    statistics of the last N seconds only merges the matching slots, so a
+    single window of 60s can serve the last 1s, 10s and 60s stats.
+
+    Options:
+
+    - **size**: the length of the window, in seconds. Defaults to 60.
+    - **resolution**: the length of a slot, in seconds. Defaults to 1.
+    - **relative_accuracy**: the accuracy of the quantile sketches.
+    - **clock**: the callable used to get the current time. Defaults to
+      :func:`loadsbase.clock.monotonic`.
+    """
+    def __init__(self, size=60., resolution=1., relative_accuracy=0.01,
+                 clock=monotonic):
+        self.size = size
+        self.resolution = resolution
+        self.relative_accuracy = relative_accuracy
+        self.clock = clock
+        self._slots = int(math.ceil(size / resolution))
+        self._ticks = [None] * self._slots
+        self._counts = [0] * self._slots
+        self._sums = [0.] * self._slots
+        self._mins = [None] * self._slots
+        self._maxs = [None] * self._slots
+        self._sketches = [None] * self._slots
+
+    def _tick(self, now):
+        if now is None:
+            now = self.clock()
+        return int(now / self.resolution)
+
+    def add(self, value, now=None):
+        """Adds *value* in the slot of the current time."""
+        tick = self._tick(now)
+        slot = tick % self._slots
+
+        if self._ticks[slot] != tick:
+            self._ticks[slot] = tick
+            self._counts[slot] = 1
+            self._sums[slot] = value
+            self._mins[slot] = self._maxs[slot] = value
+            sketch = QuantileSketch(self.relative_accuracy)
+            sketch.add(value)
+            self._sketches[slot] = sketch
+            return
+
+        self._counts[slot] += 1
+        self._sums[slot] += value
+        if value < self._mins[slot]:
+            self._mins[slot] = value
+        if value > self._maxs[slot]:
+            self._maxs[slot] = value
+        self._sketches[slot].add(value)
+
+    def stats(self, span=None, quantiles=(0.5, 0.9, 0.99), now=None):
+        """Returns the statistics of the last *span* seconds.
+
+        *span* defaults to the size of the window. The result is a mapping
+        containing the **count**, **sum**, **min**, **max** and **mean** of
+        the values, the **rate** of values per second and the estimated
+        **quantiles**, in the order of the *quantiles* option.
+        """
+        if span is None:
+            span = self.size
+        slots = min(int(math.ceil(span / self.resolution)), self._slots)
+        current = self._tick(now)
+        oldest = current - slots
+
+        count = 0
+        sum_ = 0.
+        min_ = max_ = None
+        sketch = QuantileSketch(self.relative_accuracy)
+
+        for slot, tick in enumerate(self._ticks):
+            if tick is None or not oldest < tick <= current:
+                continue
+            count += self._counts[slot]
+            sum_ += self._sums[slot]
+            if min_ is None or self._mins[slot] < min_:
+                min_ = self._mins[slot]
+            if max_ is None or self._maxs[slot] > max_:
+                max_ = self._maxs[slot]
+            sketch.merge(self._sketches[slot])
+
+        res = {'count': count, 'sum': sum_, 'min': min_, 'max': max_,
+               'rate': count / (slots * self.resolution)}
+        if count:
+            res['mean'] = sum_ / count
+            res['quantiles'] = sketch.quantiles(quantiles)
+        else:
+            res['mean'] = None
+            res['quantiles'] = [None] * len(quantiles)
+        return res
+
+
+class Timer(object):
+    """Accumulates the durations recorded under a name.
+
+    Everything is allocated when the timer is created, so :meth:`record`
+    can be called on hot paths.
+    """
+    __slots__ = ('name', 'histogram', 'record')
+
+    def __init__(self, name, **options):
+        self.name = name
+        self.histogram = Histogram(**options)
+        # records a duration, in seconds
+        self.record = self.histogram.add
+
+    def snapshot(self, quantiles=(0.5, 0.9, 0.99)):
+        """Returns the **count**, **sum**, **min**, **max**, **mean** and
+        estimated **quantiles** of the recorded durations."""
+        hist = self.histogram
+        res = {'count': hist.count, 'sum': hist.sum, 'min': hist.min,
+               'max': hist.max}
+        if hist.count:
+            res['mean'] = hist.sum / hist.count
+            res['quantiles'] = hist.quantiles(quantiles)
+        else:
+            res['mean'] = None
+            res['quantiles'] = [None] * len(quantiles)
+        return res
+
+    def reset(self):
+        hist = self.histogram
+        hist.counts[:] = [0] * len(hist.counts)
+        hist.count = 0
+        hist.sum = 0.
+        hist.min = hist.max = None
+
+
+class TimerRegistry(object):
+    """A set of named :class:`Timer`.
+
+    The options are passed to the :class:`Histogram` of every timer.
+    """
+    def __init__(self, **options):
+        self.options = options
+        self._timers = {}
+
+    def __contains__(self, name):
+        return name in self._timers
+
+    def get(self, name):
+        """Returns the timer called *name*, creating it if needed."""
+        timer = self._timers.get(name)
+        if timer is None:
+            timer = self._timers[name] = Timer(name, **self.options)
+        return timer
+
+    def snapshot(self, quantiles=(0.5, 0.9, 0.99), reset=False):
+        """Returns a mapping of the snapshots of every timer, by name.
+
+        If *reset* is True, the timers are reset once read.
+        """
+        res = {}
+        for name, timer in self._timers.items():
+            res[name] = timer.snapshot(quantiles)
+            if reset:
+                timer.reset()
+        return res
+
+
+# the default registry, used by loadsbase.util.timed
+timers = TimerRegistry()
@@ -0,0 +1,58 @@
+import sys
+import threading
+
+import unittest2
+
+from loadsbase.clock import ClockOffset, _linux_monotonic, monotonic
+
+
+class TestClock(unittest2.TestCase):
+
+    def test_monotonic(self):
+        values = [monotonic() for i in range(1000)]
+        self.assertEqual(values, sorted(values))
+
+    @unittest2.skipUnless(sys.platform.startswith('linux'), 'linux only')
+    def test_linux_monotonic_threads(self):
+        # switching threads as often as possible, across a second boundary,
+        # so a thread would notice the seconds or nanoseconds of another
+        clock = _linux_monotonic()
+        deadline = int(clock()) + 1.1
+        errors = []
+
+        def _run():
+            last = clock()
+            while last < deadline:
+                value = clock()
+                if value < last:
+                    errors.append((last, value))
+                last = value
+
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            threads = [threading.Thread(target=_run) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertEqual(errors, [])
+
+    def test_offset(self):
+        offset = ClockOffset(window=3)
+        self.assertEqual(offset.offset, None)
+        self.assertEqual(offset.to_remote(10.), 10.)
+
+        # the remote clock is 5s ahead, transit times vary
+        offset.add(105., local_time=100.5)
+        offset.add(110., local_time=105.1)
+        self.assertAlmostEqual(offset.offset, 4.9)
+        self.assertAlmostEqual(offset.to_remote(200.), 204.9)
+
+        # old samples are forgotten
+        for i in range(3):
+            offset.add(120., local_time=115.2)
+        self.assertEqual(len(offset), 3)
+        self.assertAlmostEqual(offset.offset, 4.8)
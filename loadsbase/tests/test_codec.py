@@ -0,0 +1,118 @@
+import datetime
+import os
+import tempfile
+import types
+from StringIO import StringIO
+
+import mock
+import unittest2
+
+from loadsbase import codec
+from loadsbase.codec import (BinaryCodec, ResultWriter, get_codec,
+                             read_results)
+
+
+_HIT = {'url': u'http://127.0.0.1:9200/', 'method': u'GET', 'status': 200,
+        'started': datetime.datetime(2013, 5, 30, 18, 35, 11, 550482),
+        'elapsed': datetime.timedelta(0, 0, 126509),
+        'loads_status': [1, 1, 3, 0]}
+
+_VALUES = [None, True, False, 0, 127, 128, -1, -32, -33, 300, -300, 70000,
+           -70000, 2 ** 40, -2 ** 40, 2 ** 64 - 1, -2 ** 63, 1.5, -0.25,
+           'bytes', u'uni\xe9', 'x' * 300, u'y' * 70000, range(20),
+           dict((str(i), i) for i in range(20)),
+           datetime.datetime(1969, 12, 31, 23, 59, 59, 1),
+           datetime.timedelta(-3, 12, 126509), _HIT]
+
+
+class TestCodec(unittest2.TestCase):
+
+    def test_get_codec(self):
+        self.assertEqual(get_codec().name, 'json')
+        self.assertEqual(get_codec('binary').name, 'binary')
+        self.assertRaises(ValueError, get_codec, 'xml')
+
+    def test_json(self):
+        json = get_codec('json')
+        decoded = json.decode(json.encode(_HIT))
+        self.assertEqual(decoded['started'], '2013-05-30T18:35:11.550482')
+        self.assertEqual(decoded['elapsed'], 0.126509)
+        self.assertEqual(decoded['status'], 200)
+
+    def _test_binary(self, binary):
+        for value in _VALUES:
+            self.assertEqual(binary.decode(binary.encode(value)), value)
+
+        # str values are binary data, unicode values are strings
+        self.assertTrue(isinstance(binary.decode(binary.encode('a')), str))
+        self.assertTrue(isinstance(binary.decode(binary.encode(u'a')),
+                                   unicode))
+        self.assertRaises(TypeError, binary.encode, object())
+
+        data = binary.encode(_HIT)
+        self.assertTrue(len(data) < len(get_codec('json').encode(_HIT)))
+
+    def test_binary(self):
+        self._test_binary(BinaryCodec())
+
+    def test_binary_pure_python(self):
+        with mock.patch.object(codec, 'msgpack', None):
+            self._test_binary(BinaryCodec())
+            encoded = [BinaryCodec().encode(value) for value in _VALUES]
+
+        # the pure Python implementation produces the same data as msgpack
+        if codec.msgpack is not None:
+            binary = BinaryCodec()
+            self.assertEqual([binary.encode(value) for value in _VALUES],
+                             encoded)
+
+    def test_batch(self):
+        hits = [dict(_HIT, status=status) for status in (200, 404, 500)]
+        for name in ('json', 'binary'):
+            codec = get_codec(name)
+            self.assertEqual(codec.decode_batch(codec.encode_batch([])), [])
+            decoded = codec.decode_batch(codec.encode_batch(hits))
+            self.assertEqual([hit['status'] for hit in decoded],
+                             [200, 404, 500])
+
+        binary = get_codec('binary')
+        self.assertEqual(binary.decode_batch(binary.encode_batch(hits)), hits)
+        self.assertTrue(len(binary.encode_batch(hits)) <
+                        len(binary.encode(hits)))
+
+
+class TestResultStream(unittest2.TestCase):
+
+    def test_round_trip(self):
+        records = [dict(_HIT, status=status) for status in range(100)]
+        records.append({'started': datetime.datetime(1850, 1, 1),
+                        'nested': [{'elapsed': datetime.timedelta(-1)}]})
+        fileobj = StringIO()
+        writer = ResultWriter(fileobj)
+        writer.write(records[0])
+        writer.write_many(records[1:])
+        self.assertEqual(writer.count, 101)
+        self.assertEqual(len(fileobj.getvalue().splitlines()), 101)
+
+        fileobj.seek(0)
+        read = read_results(fileobj)
+        self.assertTrue(isinstance(read, types.GeneratorType))
+        self.assertEqual(list(read), records)
+
+    def test_path(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        # the writer appends to the file
+        for i in range(2):
+            with ResultWriter(path, flush=True) as writer:
+                writer.write({'i': i})
+        self.assertEqual(list(read_results(path)), [{'i': 0}, {'i': 1}])
+
+    def test_partial_lines(self):
+        fileobj = StringIO('{"i":0}\n\n{"i":1}\n{"i":')
+        self.assertEqual(list(read_results(fileobj)), [{'i': 0}, {'i': 1}])
+
+        fileobj = StringIO('{"i":0}\n{"i":\n{"i":1}\n')
+        self.assertRaises(ValueError, list, read_results(fileobj))
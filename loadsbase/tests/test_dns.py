@@ -0,0 +1,279 @@
+from tempfile import mkdtemp
+import os
+import shutil
+import socket
+import time
+import unittest2
+
+from loadsbase import util
+from loadsbase.dns import (DNSCache, prefetch, AddressSelector,
+                           RoundRobinSelector, LeastFailureSelector,
+                           LatencyWeightedSelector, SharedDNSCache)
+from loadsbase.util import (dns_resolve, dns_prefetch, set_dns_selector,
+                            set_dns_cache,
+                            dns_report_failure, dns_report_success)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class FakeResolver(object):
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, host):
+        self.calls.append(host)
+        if host.startswith('unknown'):
+            raise socket.gaierror(-2, 'Name or service not known')
+        return ['10.0.0.%d' % len(self.calls)]
+
+
+class TestDNSCache(unittest2.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.resolver = FakeResolver()
+        self.cache = DNSCache(max_size=2, ttl=10, negative_ttl=1,
+                              resolver=self.resolver, clock=self.clock)
+
+    def test_ttl(self):
+        self.assertEqual(self.cache.resolve('a'), ['10.0.0.1'])
+        self.clock.now = 9
+        self.assertEqual(self.cache.resolve('a'), ['10.0.0.1'])
+        self.assertTrue('a' in self.cache)
+
+        self.clock.now = 10
+        self.assertFalse('a' in self.cache)
+        self.assertEqual(self.cache.resolve('a'), ['10.0.0.2'])
+        self.assertEqual(self.cache.stats(), {'size': 1, 'hits': 1,
+                                              'misses': 2, 'evictions': 0})
+
+    def test_lru(self):
+        self.cache.resolve('a')
+        self.cache.resolve('b')
+        self.cache.resolve('a')
+        self.cache.resolve('c')
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertTrue('a' in self.cache)
+        self.assertFalse('b' in self.cache)
+
+    def test_negative(self):
+        self.assertRaises(socket.gaierror, self.cache.resolve, 'unknown')
+        self.assertRaises(socket.gaierror, self.cache.resolve, 'unknown')
+        self.assertEqual(self.resolver.calls, ['unknown'])
+
+        self.clock.now = 1
+        self.assertRaises(socket.gaierror, self.cache.resolve, 'unknown')
+        self.assertEqual(len(self.resolver.calls), 2)
+
+    def test_dns_resolve(self):
+        old_cache = util._DNS_CACHE
+        util._DNS_CACHE = self.cache
+        try:
+            url, original, resolved = dns_resolve('http://example.com/path')
+            self.assertEqual(url, 'http://10.0.0.1:80/path')
+            self.assertEqual((original, resolved), ('example.com', '10.0.0.1'))
+            dns_resolve('http://example.com:8080/')
+            self.assertEqual(self.cache.hits, 1)
+        finally:
+            util._DNS_CACHE = old_cache
+
+
+class TestPrefetch(unittest2.TestCase):
+
+    def test_prefetch(self):
+        resolver = FakeResolver()
+        cache = DNSCache(resolver=resolver)
+        cache.set('cached.com', ['10.0.0.100'])
+
+        hosts = ['a%d.com' % i for i in range(20)]
+        report = prefetch(hosts + ['unknown.com', 'cached.com', 'a1.com'],
+                          cache, workers=4)
+
+        self.assertEqual(sorted(resolver.calls), sorted(hosts +
+                                                        ['unknown.com']))
+        self.assertEqual(report['cached'], 1)
+        self.assertEqual(sorted(report['resolved']), sorted(hosts))
+        self.assertEqual(list(report['failed']), ['unknown.com'])
+        self.assertTrue(report['duration'] >= 0)
+        for host in hosts:
+            self.assertTrue(host in cache)
+
+    def test_dns_prefetch(self):
+        old_cache = util._DNS_CACHE
+        util._DNS_CACHE = cache = DNSCache(resolver=FakeResolver())
+        try:
+            report = dns_prefetch(['http://example.com:8080/',
+                                   'https://example.com/path',
+                                   'http://other.com'])
+            self.assertEqual(sorted(report['resolved']),
+                             ['example.com', 'other.com'])
+            dns_resolve('http://example.com/')
+            self.assertEqual(cache.hits, 1)
+        finally:
+            util._DNS_CACHE = old_cache
+
+
+class TestSelectors(unittest2.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.addrs = ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+
+    def test_ejection(self):
+        selector = AddressSelector(max_failures=2, ejection_time=10,
+                                   clock=self.clock)
+        selector.report_failure('10.0.0.1')
+        self.assertFalse(selector.is_ejected('10.0.0.1'))
+        selector.report_failure('10.0.0.1')
+        self.assertTrue(selector.is_ejected('10.0.0.1'))
+
+        for i in range(50):
+            self.assertNotEqual(selector.select('host', self.addrs),
+                                '10.0.0.1')
+
+        # when everything is ejected, we still pick something
+        self.assertEqual(selector.select('host', ['10.0.0.1']), '10.0.0.1')
+
+        self.clock.now = 10
+        self.assertFalse(selector.is_ejected('10.0.0.1'))
+
+        selector.report_failure('10.0.0.1')
+        self.assertTrue(selector.is_ejected('10.0.0.1'))
+        selector.report_success('10.0.0.1')
+        self.assertFalse(selector.is_ejected('10.0.0.1'))
+
+    def test_round_robin(self):
+        selector = RoundRobinSelector(max_failures=1, clock=self.clock)
+        picked = [selector.select('host', self.addrs) for i in range(6)]
+        self.assertEqual(picked, self.addrs * 2)
+
+        selector.report_failure('10.0.0.2')
+        picked = [selector.select('host', self.addrs) for i in range(4)]
+        self.assertEqual(sorted(set(picked)), ['10.0.0.1', '10.0.0.3'])
+
+    def test_least_failure(self):
+        selector = LeastFailureSelector(max_failures=10, clock=self.clock)
+        selector.report_failure('10.0.0.1')
+        self.clock.now = 1
+        selector.report_failure('10.0.0.2')
+        picked = set(selector.select('host', self.addrs) for i in range(4))
+        self.assertEqual(picked, set(['10.0.0.3']))
+
+        self.clock.now = 2
+        selector.report_failure('10.0.0.3')
+        self.assertEqual(selector.select('host', self.addrs), '10.0.0.1')
+
+    def test_latency_weighted(self):
+        selector = LatencyWeightedSelector(clock=self.clock)
+        selector.report_success('10.0.0.1', latency=0.01)
+        selector.report_success('10.0.0.2', latency=1.)
+        picked = [selector.select('host', self.addrs[:2])
+                  for i in range(1000)]
+        self.assertTrue(picked.count('10.0.0.1') > 900)
+
+        # unknown addresses are considered as fast as the fastest one
+        picked = [selector.select('host', self.addrs) for i in range(1000)]
+        self.assertTrue(picked.count('10.0.0.3') > 300)
+
+    def test_dns_resolve(self):
+        old_cache = util._DNS_CACHE
+        util._DNS_CACHE = DNSCache()
+        util._DNS_CACHE.set('example.com', self.addrs)
+        set_dns_selector(RoundRobinSelector(max_failures=1))
+        try:
+            dns_report_failure('10.0.0.2')
+            picked = [dns_resolve('http://example.com')[2]
+                      for i in range(4)]
+            self.assertEqual(picked, ['10.0.0.1', '10.0.0.3'] * 2)
+
+            dns_report_success('10.0.0.2', latency=0.1)
+            picked = [dns_resolve('http://example.com')[2]
+                      for i in range(3)]
+            self.assertEqual(sorted(picked), self.addrs)
+        finally:
+            util._DNS_CACHE = old_cache
+            set_dns_selector(AddressSelector())
+
+
+class TestSharedDNSCache(unittest2.TestCase):
+
+    def setUp(self):
+        self.workdir = mkdtemp()
+        self.path = os.path.join(self.workdir, 'dns')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_shared(self):
+        resolver1 = FakeResolver()
+        resolver2 = FakeResolver()
+        cache1 = SharedDNSCache(self.path, resolver=resolver1)
+        cache2 = SharedDNSCache(self.path, resolver=resolver2)
+
+        self.assertEqual(cache1.resolve('example.com'), ['10.0.0.1'])
+        self.assertEqual(cache2.resolve('example.com'), ['10.0.0.1'])
+        self.assertEqual(resolver2.calls, [])
+
+        self.assertRaises(socket.gaierror, cache1.resolve, 'unknown.com')
+        self.assertRaises(socket.gaierror, cache2.resolve, 'unknown.com')
+        self.assertEqual(resolver2.calls, [])
+
+    def test_expiration(self):
+        resolver = FakeResolver()
+        cache1 = SharedDNSCache(self.path, ttl=0.05, resolver=resolver)
+        cache2 = SharedDNSCache(self.path, resolver=resolver)
+
+        cache1.resolve('example.com')
+        time.sleep(0.1)
+        self.assertEqual(cache2.resolve('example.com'), ['10.0.0.2'])
+
+    def test_processes(self):
+        calls = os.path.join(self.workdir, 'calls')
+
+        def _resolver(host):
+            with open(calls, 'a') as f:
+                f.write(host + '\n')
+            return ['10.0.0.1']
+
+        cache = SharedDNSCache(self.path, resolver=_resolver)
+        set_dns_cache(cache)
+        try:
+            pids = []
+            for i in range(4):
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        dns_resolve('http://example.com')
+                    finally:
+                        os._exit(0)
+                pids.append(pid)
+
+            for pid in pids:
+                os.waitpid(pid, 0)
+
+            # the children shared their resolution, and so do we
+            resolved = dns_resolve('http://example.com')
+            self.assertEqual(resolved[2], '10.0.0.1')
+            with open(calls) as f:
+                self.assertEqual(f.read(), 'example.com\n')
+        finally:
+            set_dns_cache(DNSCache())
+
+    def test_threads(self):
+        hosts = ['host%d.com' % i for i in range(200)]
+        cache = SharedDNSCache(self.path, resolver=lambda host: ['10.0.0.1'])
+        report = prefetch(hosts, cache, workers=20)
+        self.assertEqual(len(report['resolved']), 200)
+        self.assertEqual(report['failed'], {})
+
+        # every host was written to the shared table
+        other = SharedDNSCache(self.path, resolver=FakeResolver())
+        self.assertEqual(sorted(other._read()), sorted(hosts))
+        self.assertEqual(sorted(os.listdir(self.workdir)), ['dns', 'dns.lock'])
@@ -54,6 +54,27 @@ class TestHeartbeat(unittest2.TestCase):
         self.assertEqual(len(lost),  0, len(lost))
         self.assertTrue(len(beats) > 2, len(beats))
 
+        # the clocks are the same, the offset is the transit time
+        self.assertTrue(len(stetho.clock_offset) > 2)
+        self.assertTrue(abs(stetho.clock_offset.offset) < .1)
+        self.assertTrue(abs(stetho.remote_time() - time.time()) < .1)
+
+    def test_timestamps(self):
+        beats = []
+        stetho = Stethoscope('ipc:///tmp/stetho.ipc',
+                             onbeat=lambda: beats.append('.'),
+                             io_loop=ioloop.IOLoop())
+
+        # beats without timestamps are still accepted
+        stetho._handle_recv(['BEAT'])
+        stetho._handle_recv(['BEAT', 'garbage'])
+        self.assertEqual(beats, ['.', '.'])
+        self.assertEqual(stetho.clock_offset.offset, None)
+        self.assertEqual(stetho.remote_time(12.), 12.)
+
+        stetho._handle_recv(['BEAT', repr(time.time() + 100)])
+        self.assertTrue(99 < stetho.remote_time() - time.time() <= 100)
+
     def test_lost(self):
         beats = []
         lost = []
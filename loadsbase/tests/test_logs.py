@@ -0,0 +1,110 @@
+import logging
+import os
+import threading
+from tempfile import mkstemp
+
+import unittest2
+
+from loadsbase.logs import BackgroundHandler
+from loadsbase.util import set_logger
+
+
+class ListHandler(logging.Handler):
+    def __init__(self, event=None):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.event = event
+
+    def emit(self, record):
+        if self.event is not None:
+            self.event.wait()
+        self.records.append(record)
+
+
+class TestBackgroundHandler(unittest2.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('loads.test_logs')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+
+    def test_background(self):
+        target = ListHandler()
+        target.setLevel(logging.INFO)
+        handler = BackgroundHandler([target])
+        self.logger.addHandler(handler)
+
+        args = ['mutable']
+        self.logger.info('one %s', args)
+        args.append('changed')
+        self.logger.debug('filtered by the target')
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.logger.exception('two')
+
+        handler.close()
+        self.assertEqual([record.getMessage() for record in target.records],
+                         ["one ['mutable']", 'two'])
+        self.assertTrue('ValueError: boom' in target.records[1].exc_text)
+
+    def test_other_handlers(self):
+        # the records given to the other handlers are left unchanged
+        handler = BackgroundHandler([ListHandler()])
+        other = ListHandler()
+        self.logger.addHandler(handler)
+        self.logger.addHandler(other)
+
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.logger.exception('failed %s', 'here')
+
+        handler.close()
+        record = other.records[0]
+        self.assertEqual(record.args, ('here',))
+        self.assertEqual(record.exc_info[0], ValueError)
+
+    def test_drops(self):
+        # the target is blocked until the queue is full
+        event = threading.Event()
+        target = ListHandler(event)
+        handler = BackgroundHandler([target], queue_size=2)
+        self.logger.addHandler(handler)
+
+        for i in range(10):
+            self.logger.info('%d', i)
+        self.assertTrue(handler.dropped >= 7)
+
+        event.set()
+        handler.close()
+        messages = [record.getMessage() for record in target.records]
+        self.assertEqual(len(messages), 11 - handler.dropped)
+        self.assertEqual(messages[-1],
+                         '%d log records dropped' % handler.dropped)
+
+    def test_set_logger(self):
+        fd, logfile = mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, logfile)
+        self.addCleanup(os.remove, logfile + '.1')
+
+        handler = set_logger(name='loads.test_logs', logfile=logfile,
+                             background=True, max_bytes=1000)
+        self.assertTrue(isinstance(handler, BackgroundHandler))
+        for i in range(50):
+            self.logger.info('x' * 30)
+        self.logger.debug('not logged')
+        handler.close()
+
+        # the file was rotated
+        self.assertTrue(os.path.getsize(logfile) <= 1000)
+        with open(logfile + '.1') as f:
+            self.assertTrue('x' * 30 in f.read())
+        with open(logfile) as f:
+            self.assertFalse('not logged' in f.read())
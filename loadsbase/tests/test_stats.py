@@ -0,0 +1,231 @@
+import random
+import unittest2
+
+from loadsbase.stats import (QuantileSketch, Histogram, RollingWindow,
+                             TimerRegistry, timers)
+from loadsbase.util import get_quantiles, timed
+
+
+class TestQuantileSketch(unittest2.TestCase):
+
+    def _assert_close(self, estimates, exact, accuracy):
+        for estimate, value in zip(estimates, exact):
+            self.assertTrue(abs(estimate - value) <= value * accuracy,
+                            (estimate, value))
+
+    def test_quantiles(self):
+        data = [random.expovariate(10) for i in range(10000)]
+        sketch = QuantileSketch(relative_accuracy=0.01)
+        for value in data:
+            sketch.add(value)
+
+        self.assertEqual(len(sketch), 10000)
+        quantiles = [0.99, 0.5, 0.9, 0.1]
+        self._assert_close(sketch.quantiles(quantiles),
+                           get_quantiles(data, quantiles), 0.02)
+
+        self.assertEqual(sketch.quantiles([0, 1]), [min(data), max(data)])
+
+    def test_zeros_and_errors(self):
+        sketch = QuantileSketch()
+        self.assertRaises(ValueError, sketch.quantiles, [0.5])
+        self.assertRaises(ValueError, sketch.add, -1)
+        self.assertRaises(ValueError, QuantileSketch, relative_accuracy=2)
+
+        sketch.add(0, count=10)
+        sketch.add(1)
+        self.assertEqual(sketch.quantiles([0.5, 1]), [0, 1])
+        self.assertRaises(ValueError, sketch.quantiles, [1.5])
+
+    def test_bounded(self):
+        sketch = QuantileSketch(max_bins=10)
+        for i in range(1, 1000):
+            sketch.add(i)
+        self.assertEqual(len(sketch._bins), 10)
+        self._assert_close(sketch.quantiles([0.99]), [989], 0.01)
+
+    def test_merge(self):
+        sketch1 = QuantileSketch()
+        sketch2 = QuantileSketch()
+        for i in range(1, 501):
+            sketch1.add(i)
+            sketch2.add(i + 500)
+
+        sketch1.merge(sketch2)
+        self.assertEqual(sketch1.count, 1000)
+        self.assertEqual(sketch1.max, 1000)
+        self._assert_close(sketch1.quantiles([0.5]), [500], 0.01)
+        self.assertRaises(ValueError, sketch1.merge,
+                          QuantileSketch(relative_accuracy=0.05))
+
+
+class TestHistogram(unittest2.TestCase):
+
+    def test_quantiles(self):
+        data = [random.expovariate(10) for i in range(10000)]
+        hist = Histogram()
+        for value in data:
+            hist.add(value)
+
+        quantiles = [0.5, 0.9, 0.99]
+        for estimate, value in zip(hist.quantiles(quantiles),
+                                   get_quantiles(data, quantiles)):
+            self.assertTrue(abs(estimate - value) <= value * 0.02,
+                            (estimate, value))
+
+        self.assertEqual(hist.quantiles([0, 1]), [min(data), max(data)])
+        self.assertRaises(ValueError, Histogram().quantiles, [0.5])
+
+    def test_big_values(self):
+        hist = Histogram(max_value=10)
+        hist.add(1000)
+        self.assertEqual(hist.quantiles([0.5]), [1000])
+        self.assertEqual(hist.counts[-1], 1)
+
+    def test_merge_and_serialize(self):
+        hist1 = Histogram()
+        hist2 = Histogram()
+        for i in range(1000):
+            hist1.add(i / 1000.)
+            hist2.add(i / 100.)
+
+        data = hist2.dumps()
+        self.assertTrue(isinstance(data, str))
+        self.assertTrue(len(data) < 4000)
+
+        loaded = Histogram.loads(data)
+        self.assertEqual(loaded.counts, hist2.counts)
+        self.assertEqual((loaded.count, loaded.min, loaded.max),
+                         (hist2.count, hist2.min, hist2.max))
+
+        hist1.merge(loaded)
+        self.assertEqual(hist1.count, 2000)
+        self.assertEqual(hist1.max, 9.99)
+
+        self.assertRaises(ValueError, hist1.merge, Histogram(max_value=10))
+        self.assertRaises(ValueError, Histogram.loads, 'garbage')
+
+        # truncated or corrupt bodies
+        header = Histogram._header.size
+        for invalid in (data[:-1], data[:header + 1],
+                        data[:header] + '\xff' * 20,
+                        data[:header] + '\x80\x80\x80\x01\x01',
+                        data[:header] + '\x00',
+                        Histogram._header.pack('LHST', 1, 8, 0., 10, 0, 0.,
+                                               0., 0.)):
+            self.assertRaises(ValueError, Histogram.loads, invalid)
+
+    def test_zmq_transport(self):
+        import zmq
+        ctx = zmq.Context()
+        sender = ctx.socket(zmq.PAIR)
+        receiver = ctx.socket(zmq.PAIR)
+        sender.bind('inproc://histogram')
+        receiver.connect('inproc://histogram')
+        try:
+            hist = Histogram()
+            hist.add(0.25)
+            sender.send(hist.dumps())
+            received = Histogram.loads(receiver.recv())
+            self.assertEqual(received.counts, hist.counts)
+        finally:
+            sender.close()
+            receiver.close()
+            ctx.term()
+
+
+class TestRollingWindow(unittest2.TestCase):
+
+    def test_stats(self):
+        window = RollingWindow(size=10, resolution=1.)
+
+        for second in range(20):
+            for i in range(second + 1):
+                window.add(second + i / 100., now=100 + second)
+
+        # only the last 10 seconds are kept
+        stats = window.stats(now=119.5)
+        self.assertEqual(stats['count'], sum(range(11, 21)))
+        self.assertEqual(stats['min'], 10)
+        self.assertEqual(stats['max'], 19.19)
+        self.assertEqual(stats['rate'], stats['count'] / 10.)
+
+        stats = window.stats(span=1, now=119.5)
+        self.assertEqual(stats['count'], 20)
+        self.assertEqual(stats['rate'], 20)
+        median = stats['quantiles'][0]
+        self.assertTrue(abs(median - 19.1) < 0.2, median)
+
+        # nothing happened during the last 5 seconds
+        stats = window.stats(span=5, now=124.5)
+        self.assertEqual(stats['count'], 0)
+        self.assertEqual(stats['mean'], None)
+        self.assertEqual(stats['quantiles'], [None, None, None])
+
+    def test_timed(self):
+        window = RollingWindow()
+
+        @timed(window=window)
+        def _func():
+            return 'ok'
+
+        for i in range(5):
+            _func()
+
+        self.assertEqual(window.stats()['count'], 5)
+
+
+class TestTimerRegistry(unittest2.TestCase):
+
+    def test_named_timed(self):
+        registry = TimerRegistry()
+
+        @timed(name='func', registry=registry)
+        def _func(value):
+            return value
+
+        self.assertTrue('func' in registry)
+        self.assertEqual(_func.__name__, '_func')
+
+        for i in range(10):
+            self.assertEqual(_func(i), i)
+
+        snapshot = registry.snapshot(reset=True)
+        self.assertEqual(snapshot['func']['count'], 10)
+        self.assertEqual(len(snapshot['func']['quantiles']), 3)
+
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['func']['count'], 0)
+        self.assertEqual(snapshot['func']['mean'], None)
+
+    def test_named_timed_window(self):
+        registry = TimerRegistry()
+        window = RollingWindow()
+
+        @timed(name='func', registry=registry, window=window)
+        def _func():
+            return 'ok'
+
+        for i in range(5):
+            self.assertEqual(_func(), 'ok')
+
+        self.assertEqual(window.stats()['count'], 5)
+        self.assertEqual(registry.get('func').histogram.count, 5)
+
+    def test_errors_are_recorded(self):
+        registry = TimerRegistry()
+
+        @timed(name='boom', registry=registry)
+        def _boom():
+            raise ValueError()
+
+        self.assertRaises(ValueError, _boom)
+        self.assertEqual(registry.get('boom').histogram.count, 1)
+
+    def test_default_registry(self):
+        @timed(name='loadsbase.tests.default')
+        def _func():
+            pass
+
+        _func()
+        self.assertTrue('loadsbase.tests.default' in timers)
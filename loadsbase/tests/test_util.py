@@ -5,14 +5,28 @@ import os
 import unittest2 as unittest2
 import sys
 import StringIO
+import subprocess
 import shutil
+import array
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from loadsbase import util
+from loadsbase.dns import DNSCache
 import loadsbase
 from loadsbase.util import (resolve_name, set_logger, logger, dns_resolve,
                             DateTimeJSONEncoder, try_import, split_endpoint,
                             null_streams, get_quantiles, pack_include_files,
-                            unpack_include_files, dict_hash)
+                            unpack_include_files, dict_hash, parse_url,
+                            pack_include_chunks, unpack_include_chunks,
+                            write_include_files, extract_include_files,
+                            get_include_manifest, IncludeFilesCache, glob,
+                            DirectoryListing, ThrottledLogger, timed)
 
 
 class FakeStdout(object):
@@ -28,7 +42,7 @@ class FakeStdout(object):
 
 class TestUtil(unittest2.TestCase):
     def setUp(self):
-        util._DNS_CACHE = {}
+        util._DNS_CACHE = DNSCache()
         self.stdout = sys.stdout
         sys.stdout = FakeStdout()
 
@@ -46,6 +60,7 @@ class TestUtil(unittest2.TestCase):
         self.assertRaises(ImportError, resolve_name, 'loads.xx')
 
     @mock.patch('sys.path', [])
+    @mock.patch('loadsbase.util._RESOLVED', {})
     def test_resolve_adds_path(self):
         ob = resolve_name('loadsbase.tests.test_util.TestUtil')
         self.assertTrue(ob is TestUtil)
@@ -56,6 +71,49 @@ class TestUtil(unittest2.TestCase):
         ob = resolve_name('loadsbase.tests.test_util.TestUtil')
         self.assertEquals(len(sys.path), old_len)
 
+    @mock.patch('loadsbase.util._RESOLVED', {})
+    def test_resolve_is_cached(self):
+        name = 'loadsbase.tests.test_util.TestUtil.test_resolve'
+        with mock.patch('loadsbase.util._import',
+                        side_effect=util._import) as _import:
+            for i in range(3):
+                self.assertEqual(resolve_name(name), TestUtil.test_resolve)
+        _import.assert_called_once_with('loadsbase')
+
+        # submodules are imported when they are not attributes yet
+        ob = resolve_name('xml.dom.minidom.parseString')
+        self.assertTrue(ob is sys.modules['xml.dom.minidom'].parseString)
+
+        self.assertRaises(ImportError, resolve_name, 'loadsbase.util.nope')
+        self.assertRaises(ImportError, resolve_name, 'loadsbase.nope')
+        self.assertFalse('loadsbase.nope' in util._RESOLVED)
+
+    @mock.patch('loadsbase.util._RESOLVED', {})
+    def test_resolve_threads(self):
+        name = 'loadsbase.tests.test_util.TestUtil'
+        pool = ThreadPool(8)
+        try:
+            resolved = pool.map(resolve_name, [name] * 100)
+        finally:
+            pool.close()
+        self.assertTrue(all(ob is TestUtil for ob in resolved))
+
+    def test_lazy_imports(self):
+        # the slow modules are only imported when needed
+        code = ('import sys, loadsbase.util; '
+                'print(" ".join(sorted(sys.modules)))')
+        # check_output() is not in Python 2.6
+        process = subprocess.Popen([sys.executable, '-c', code],
+                                   stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0)
+        loaded = set(output.split())
+        for name in ('numpy', 'zipfile', 'tempfile', 'shutil', 'urlparse',
+                     'hashlib', 'random', 'multiprocessing', 'subprocess',
+                     'logging.handlers', 'fcntl', 'ctypes', 'loadsbase.dns',
+                     'loadsbase.logs'):
+            self.assertFalse(name in loaded, name)
+
     def test_set_logger(self):
         before = len(logger.handlers)
         set_logger()
@@ -80,6 +138,97 @@ class TestUtil(unittest2.TestCase):
         self.assertRaises(NotImplementedError, split_endpoint,
                           'wat://ddf:ff:f')
 
+    def test_parse_url(self):
+        url = 'https://example.com:8443/path;params?query=1#fragment'
+        parsed = parse_url(url)
+        self.assertTrue(parse_url(url) is parsed)
+        self.assertEqual(parsed.scheme, 'https')
+        self.assertEqual(parsed.host, 'example.com')
+        self.assertEqual(parsed.port, 8443)
+        self.assertEqual(parsed.path, '/path')
+        self.assertEqual(parsed.with_host('10.0.0.1'),
+                         'https://10.0.0.1:8443/path;params?query=1#fragment')
+
+        parsed = parse_url('http://example.com')
+        self.assertEqual(parsed.port, 80)
+        self.assertEqual(parsed.with_host('10.0.0.1'), 'http://10.0.0.1:80')
+
+    @mock.patch('loadsbase.util._URL_CACHE_SIZE', 10)
+    def test_parse_url_cache_is_bounded(self):
+        for i in range(20):
+            parse_url('http://example.com/%d' % i)
+        self.assertTrue(len(util._URL_CACHE) <= 10)
+
+    def test_throttled_logger_sampling(self):
+        log = mock.Mock()
+        log.isEnabledFor.return_value = True
+        throttled = ThrottledLogger(log, every=10, window=None)
+        logged = [throttled.debug('hit %d', i) for i in range(25)]
+        self.assertEqual(logged.count(True), 3)
+        self.assertTrue(logged[0] and logged[10] and logged[20])
+        self.assertEqual(log.log.call_count, 3)
+
+        # other call sites are sampled separately
+        self.assertTrue(throttled.debug('other'))
+
+        log.isEnabledFor.return_value = False
+        self.assertFalse(throttled.debug('other'))
+
+    def test_throttled_logger_rate(self):
+        now = [0.]
+        log = mock.Mock()
+        log.isEnabledFor.return_value = True
+        throttled = ThrottledLogger(log, rate=2., burst=3,
+                                    clock=lambda: now[0])
+
+        logged = [throttled.info('hit %d', i) for i in range(10)]
+        self.assertEqual(logged.count(True), 3)
+        now[0] = 1.
+        logged = [throttled.info('hit %d', i) for i in range(10)]
+        self.assertEqual(logged.count(True), 2)
+        self.assertEqual(log.log.call_count, 5)
+
+        # the suppressed calls are reported once the window elapsed
+        now[0] = 10.5
+        log.log.reset_mock()
+        self.assertTrue(throttled.info('hit %d', 0, key='hits'))
+        self.assertTrue(throttled.info('hit %d', 1))
+        self.assertEqual(log.log.call_args_list, [
+            mock.call(20, 'hit %d', 0),
+            mock.call(20, '%r repeated %d times in the last %.0fs',
+                      'hit %d', 15, 10.5),
+            mock.call(20, 'hit %d', 1)])
+
+        throttled.info('hit %d', 2)
+        throttled.info('hit %d', 3)
+        self.assertFalse(throttled.info('hit %d', 4))
+        log.log.reset_mock()
+        throttled.flush()
+        log.log.assert_called_once_with(
+            10, '%r repeated %d times in the last %.0fs', 'hit %d', 1, 0.)
+
+    def test_timed_debug(self):
+        def first():
+            return 1
+
+        def second():
+            return 2
+
+        throttled = ThrottledLogger(mock.Mock(), rate=1., window=None)
+        with mock.patch('loadsbase.util.throttled_logger', throttled):
+            first, second = timed(debug=True)(first), timed(debug=True)(second)
+            for i in range(3):
+                self.assertEqual(first()[1], 1)
+                self.assertEqual(second()[1], 2)
+
+        # each function is throttled separately
+        calls = throttled.logger.log.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0][0][:3], (10, '%s took %.4fs',
+                                           __name__ + '.first'))
+        self.assertEqual(calls[1][0][:3], (10, '%s took %.4fs',
+                                           __name__ + '.second'))
+
     def test_datetime_json_encoder(self):
         encoder = DateTimeJSONEncoder()
         date = datetime.datetime(2013, 5, 30, 18, 35, 11, 550482)
@@ -100,6 +249,31 @@ class TestUtil(unittest2.TestCase):
         res = get_quantiles(data, quantiles)
         self.assertEqual(len(res), 5)
 
+    @unittest2.skipIf(numpy is None, 'needs numpy')
+    def test_get_quantiles_arrays(self):
+        values = [(i * 7919) % 1000 / 10. for i in range(1000)]
+        quantiles = 0, 0.1, 0.5, 0.9, 0.99, 1
+        expected = get_quantiles(values, quantiles)
+
+        data = array.array('d', values)
+        self.assertEqual(get_quantiles(data, quantiles), expected)
+        self.assertEqual(data.tolist(), values)
+
+        data = numpy.array(values)
+        self.assertEqual(get_quantiles(data, quantiles), expected)
+        self.assertEqual(data.tolist(), values)
+
+        res = get_quantiles(data, quantiles, overwrite_input=True)
+        self.assertEqual(res, expected)
+        self.assertEqual(sorted(data.tolist()), sorted(values))
+
+        # an array.array is partitioned in place as well
+        data = array.array('d', values)
+        res = get_quantiles(data, quantiles, overwrite_input=True)
+        self.assertEqual(res, expected)
+        self.assertNotEqual(data.tolist(), values)
+        self.assertEqual(sorted(data.tolist()), sorted(values))
+
     def test_nullstreams(self):
         stream = StringIO.StringIO()
         null_streams([stream, sys.stdout])
@@ -141,6 +315,53 @@ class TestIncludeFileHandling(unittest2.TestCase):
         unpack_include_files(filedata, "./outdir")
         self.assertEquals(os.listdir("outdir"), ["test1.txt"])
 
+    def test_include_recursive_pattern(self):
+        os.makedirs("in/sub1/sub2")
+        for name in ("in/a.txt", "in/sub1/c.txt", "in/sub1/sub2/d.txt"):
+            with open(name, "w") as f:
+                f.write(name)
+
+        filedata = pack_include_files(["**"], "in")
+        zf = zipfile.ZipFile(StringIO.StringIO(filedata.decode("base64")))
+        self.assertEqual(sorted(zf.namelist()),
+                         ["a.txt", "sub1/c.txt", "sub1/sub2/d.txt"])
+
+        # the files matched by several patterns are only included once
+        filedata = pack_include_files(["sub1/*", "**/*.txt", "sub1"], "in")
+        zf = zipfile.ZipFile(StringIO.StringIO(filedata.decode("base64")))
+        self.assertEqual(sorted(zf.namelist()),
+                         ["a.txt", "c.txt", "sub1/c.txt", "sub1/sub2/d.txt",
+                          "sub2/d.txt"])
+
+    def test_include_with_absolute_pattern(self):
+        os.makedirs("src/sub")
+        os.makedirs("loc")
+        os.makedirs("outdir")
+        with open("src/a.txt", "w") as f:
+            f.write("a")
+        with open("src/sub/b.txt", "w") as f:
+            f.write("b")
+        src = os.path.join(self.workdir, "src")
+        filedata = pack_include_files([src + "/*.txt", src + "/sub"], "loc")
+        zf = zipfile.ZipFile(StringIO.StringIO(filedata.decode("base64")))
+        self.assertEqual(sorted(zf.namelist()), ["a.txt", "sub/b.txt"])
+
+        unpack_include_files(filedata, "outdir")
+        self.assertEqual(sorted(os.listdir("outdir")), ["a.txt", "sub"])
+
+    def test_extract_rejects_paths_outside_location(self):
+        for name in ("../evil.txt", "/../evil.txt", "a/../../evil.txt"):
+            data = StringIO.StringIO()
+            zf = zipfile.ZipFile(data, "w")
+            zf.writestr(name, "evil")
+            zf.close()
+            os.makedirs("outdir")
+            data.seek(0)
+            self.assertRaises(ValueError, extract_include_files, data,
+                              "outdir")
+            self.assertFalse(os.path.exists("evil.txt"))
+            os.rmdir("outdir")
+
     def test_preservation_of_file_mode(self):
         with open("test1.sh", "w") as f:
             f.write("#!/bin/sh\necho 'hello world'\n")
@@ -175,6 +396,211 @@ class TestIncludeFileHandling(unittest2.TestCase):
         self.assertEquals(os.listdir("./subdir"), ["subsubdir"])
         self.assertEquals(os.listdir("./subdir/subsubdir"), ["test3.txt"])
 
+    def test_include_chunks(self):
+        os.makedirs("indir/subdir")
+        with open("indir/test1.txt", "w") as f:
+            f.write("hello world")
+        with open("indir/subdir/big.bin", "wb") as f:
+            f.write(os.urandom(300000))
+
+        chunks = list(pack_include_chunks(["*"], "./indir",
+                                          chunk_size=1024))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(len(chunk) <= 1024 for chunk in chunks))
+
+        unpack_include_chunks(iter(chunks), "./outdir")
+        self.assertEquals(sorted(os.listdir("outdir")),
+                          ["subdir", "test1.txt"])
+        with open("indir/subdir/big.bin", "rb") as f:
+            with open("outdir/subdir/big.bin", "rb") as f2:
+                self.assertEqual(f.read(), f2.read())
+
+    def test_include_file(self):
+        with open("test1.txt", "w") as f:
+            f.write("hello world")
+        write_include_files(["test1.txt"], "bundle.zip")
+        extract_include_files("bundle.zip", "outdir")
+        self.assertEquals(os.listdir("outdir"), ["test1.txt"])
+
+    def test_include_compression(self):
+        os.makedirs("indir")
+        with open("indir/test1.txt", "w") as f:
+            f.write("hello world" * 1000)
+        with open("indir/test2.sh", "w") as f:
+            f.write("echo 'hello world'\n" * 1000)
+        os.chmod("indir/test2.sh", 0755)
+        with open("indir/data.gz", "wb") as f:
+            f.write("not really gzipped" * 1000)
+
+        for options in ({}, {'level': 1}, {'workers': 2, 'level': 9}):
+            write_include_files(["*"], "bundle.zip", "./indir", **options)
+            zf = zipfile.ZipFile("bundle.zip")
+            infos = dict((info.filename, info) for info in zf.infolist())
+            zf.close()
+            self.assertEqual(infos["data.gz"].compress_type,
+                             zipfile.ZIP_STORED)
+            self.assertEqual(infos["test1.txt"].compress_type,
+                             zipfile.ZIP_DEFLATED)
+            self.assertTrue(infos["test1.txt"].compress_size < 1000)
+
+            shutil.rmtree("outdir", ignore_errors=True)
+            extract_include_files("bundle.zip", "outdir")
+            for name in infos:
+                with open(os.path.join("indir", name)) as f:
+                    with open(os.path.join("outdir", name)) as f2:
+                        self.assertEqual(f.read(), f2.read())
+            self.assertEquals(os.stat("outdir/test2.sh").st_mode & 0777,
+                              0755)
+
+        filedata = pack_include_files(["*"], "./indir", workers=2,
+                                      stored_extensions=())
+        unpack_include_files(filedata, "./outdir2")
+        self.assertEquals(sorted(os.listdir("outdir2")),
+                          ["data.gz", "test1.txt", "test2.sh"])
+
+    def test_include_compression_failure(self):
+        os.makedirs("indir")
+        os.makedirs("tmp")
+        for i in range(10):
+            with open("indir/test%d.txt" % i, "w") as f:
+                f.write("hello world %d" % i)
+
+        calls = []
+        write = util._write_compressed
+
+        def _write(*args):
+            calls.append(args)
+            if len(calls) == 3:
+                raise IOError('disk full')
+            return write(*args)
+
+        tmp = os.path.join(self.workdir, "tmp")
+        with mock.patch('loadsbase.util._write_compressed', _write):
+            with mock.patch('tempfile.tempdir', tmp):
+                self.assertRaises(IOError, write_include_files, ["*"],
+                                  "bundle.zip", "./indir", workers=2)
+
+        # the files compressed ahead of the failure were removed too
+        self.assertEqual(os.listdir(tmp), [])
+
+    def test_skip_unchanged_and_parallel_extraction(self):
+        os.makedirs("indir/subdir")
+        for i in range(10):
+            with open("indir/subdir/test%d.txt" % i, "w") as f:
+                f.write("hello world %d" % i)
+        write_include_files(["*"], "bundle.zip", "./indir")
+
+        report = extract_include_files("bundle.zip", "outdir",
+                                       skip_unchanged=True, workers=4)
+        self.assertEqual(report, {'files': 10, 'skipped': 0, 'bytes': 130})
+
+        with open("outdir/subdir/test3.txt", "w") as f:
+            f.write("changed")
+        report = extract_include_files("bundle.zip", "outdir",
+                                       skip_unchanged=True, workers=4)
+        self.assertEqual(report, {'files': 10, 'skipped': 9, 'bytes': 13})
+        with open("outdir/subdir/test3.txt") as f:
+            self.assertEqual(f.read(), "hello world 3")
+
+        # the blob and chunks flavors
+        filedata = pack_include_files(["*"], "./indir")
+        report = unpack_include_files(filedata, "outdir", workers=2,
+                                      skip_unchanged=True)
+        self.assertEqual(report['skipped'], 10)
+        report = unpack_include_files(filedata, "outdir")
+        self.assertEqual(report['skipped'], 0)
+
+        chunks = pack_include_chunks(["*"], "./indir")
+        report = unpack_include_chunks(chunks, "outdir2", workers=2)
+        self.assertEqual(report['bytes'], 130)
+        self.assertEqual(len(os.listdir("outdir2/subdir")), 10)
+
+    def test_include_manifest_and_cache(self):
+        os.makedirs("indir/subdir")
+        with open("indir/test1.txt", "w") as f:
+            f.write("hello world")
+        with open("indir/subdir/test2.sh", "w") as f:
+            f.write("echo 'hello world'")
+        os.chmod("indir/subdir/test2.sh", 0755)
+
+        manifest = get_include_manifest(["*"], "./indir")
+        self.assertEqual(sorted(manifest), ["subdir/test2.sh", "test1.txt"])
+        cache = IncludeFilesCache(os.path.join(self.workdir, "cache"))
+
+        # first run, everything is shipped
+        missing = cache.missing(manifest)
+        self.assertEqual(len(missing), 2)
+        filedata = pack_include_files(["*"], "./indir", hashes=missing,
+                                      manifest=manifest)
+        unpack_include_files(filedata, "./run1", manifest, cache)
+        self.assertEqual(cache.missing(manifest), [])
+
+        # second run, only the changed file is shipped
+        with open("indir/test1.txt", "w") as f:
+            f.write("hello again")
+        manifest = get_include_manifest(["*"], "./indir")
+        missing = cache.missing(manifest)
+        self.assertEqual(missing, [manifest["test1.txt"][0]])
+        chunks = pack_include_chunks(["*"], "./indir", hashes=missing,
+                                     manifest=manifest)
+        unpack_include_chunks(chunks, "./run2", manifest, cache)
+
+        with open("run2/test1.txt") as f:
+            self.assertEqual(f.read(), "hello again")
+        with open("run2/subdir/test2.sh") as f:
+            self.assertEqual(f.read(), "echo 'hello world'")
+        self.assertEquals(os.stat("run2/subdir/test2.sh").st_mode & 0777,
+                          0755)
+
+        # nothing changed, nothing is shipped
+        missing = cache.missing(manifest)
+        filedata = pack_include_files(["*"], "./indir", hashes=missing)
+        unpack_include_files(filedata, "./run3", manifest, cache)
+        self.assertEquals(sorted(os.listdir("run3")), ["subdir", "test1.txt"])
+
+    def test_glob(self):
+        os.makedirs("indir/sub1/sub2")
+        os.makedirs("indir/other")
+        for path in ("indir/a.txt", "indir/b.csv", "indir/sub1/c.txt",
+                     "indir/sub1/sub2/d.txt", "indir/other/e.txt"):
+            with open(path, "w") as f:
+                f.write("hello world")
+
+        def _glob(*patterns):
+            res = glob(patterns, "indir", listing)
+            return sorted(os.path.relpath(path, "indir") for path in res)
+
+        calls = []
+
+        class CountingListing(DirectoryListing):
+            def __call__(self, path):
+                if path not in self._cache:
+                    calls.append(path)
+                return super(CountingListing, self).__call__(path)
+
+        listing = CountingListing()
+        self.assertEqual(_glob("*.txt", "*.csv"), ["a.txt", "b.csv"])
+        self.assertEqual(_glob("**/*.txt"),
+                         ["a.txt", "other/e.txt", "sub1/c.txt",
+                          "sub1/sub2/d.txt"])
+        self.assertEqual(_glob("sub1/**"), ["sub1", "sub1/sub2"])
+        self.assertEqual(_glob("*/sub?/*.txt"), ["sub1/sub2/d.txt"])
+        self.assertEqual(_glob("sub1/c.txt", "nothere", "nodir/*"),
+                         ["sub1/c.txt"])
+        self.assertEqual(_glob("../indir/*.csv", "./a.txt"),
+                         ["a.txt", "b.csv"])
+
+        # every directory was listed once
+        self.assertEqual(sorted(calls), sorted(set(calls)))
+
+        # the names in the bundle are relative to the start of the pattern
+        filedata = pack_include_files(["**/*.txt", "sub1/sub2/*"],
+                                      "./indir")
+        unpack_include_files(filedata, "./outdir")
+        self.assertEquals(sorted(os.listdir("outdir")),
+                          ["a.txt", "d.txt", "other", "sub1"])
+        self.assertEquals(os.listdir("outdir/sub1/sub2"), ["d.txt"])
+
     def test_unicode_unpack(self):
         # make sure we pass string
         data = (u'PK\x05\x06\x00\x00\x00\x00\x00\x00\x00\x00\x00'
@@ -193,3 +619,31 @@ class TestIncludeFileHandling(unittest2.TestCase):
 
         self.assertEqual(dict_hash(data1, omit_keys=['count']),
                          dict_hash(data2))
+
+    def test_dict_hash_is_canonical(self):
+        data1 = {'a': [1, {'x': 1, 'y': set([1, 2])}], 'b': None, u'c': 1.5}
+        data2 = {'c': 1.5, 'b': None, 'a': (1, {'y': set([2, 1]), 'x': 1})}
+        self.assertEqual(dict_hash(data1), dict_hash(data2))
+
+        # the hash is the same in every process
+        self.assertEqual(dict_hash({'a': 1, 'b': [u'\xe9', 2.5, True]}),
+                         '5b207c354d94447b9701b91b8427a273')
+
+        # types matter
+        self.assertNotEqual(dict_hash({'a': 1}), dict_hash({'a': '1'}))
+        self.assertNotEqual(dict_hash({'a': 1}), dict_hash({'a': 1.}))
+        self.assertNotEqual(dict_hash({'a': 1}), dict_hash({'a': True}))
+        self.assertNotEqual(dict_hash({'a': [1, 2]}),
+                            dict_hash({'a': [[1], 2]}))
+
+    def test_dict_hash_memoize(self):
+        data = {'a': (1, 2), 'b': 'c'}
+        res = dict_hash(data, memoize=True)
+        self.assertEqual(dict_hash(data, memoize=True), res)
+        self.assertEqual(dict_hash(data), res)
+        self.assertTrue((repr(data), ()) in util._HASH_CACHE)
+
+        data['b'] = 'd'
+        self.assertNotEqual(dict_hash(data, memoize=True), res)
+        self.assertEqual(dict_hash(data, omit_keys=['b'], memoize=True),
+                         dict_hash({'a': (1, 2)}))
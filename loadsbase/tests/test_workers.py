@@ -0,0 +1,91 @@
+import os
+import time
+
+import unittest2
+
+from loadsbase.workers import WorkerError, WorkerPool
+
+
+def add(a, b):
+    return a + b
+
+
+def crash():
+    os._exit(3)
+
+
+def fail():
+    raise ValueError('boom')
+
+
+class TestWorkerPool(unittest2.TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool(size=2, preload=['loadsbase.tests.'
+                                                'test_workers.add'])
+        self.pool.start()
+        self.addCleanup(self.pool.stop)
+
+    def test_map(self):
+        target = 'loadsbase.tests.test_workers.add'
+        res = self.pool.map(target, [(i, 1) for i in range(20)], timeout=10)
+        self.assertEqual(res, range(1, 21))
+
+        pids = self.pool.map('os.getpid', [()] * 10, timeout=10)
+        self.assertTrue(os.getpid() not in pids)
+        self.assertTrue(len(set(pids)) <= 2)
+
+        stats = self.pool.stats()
+        self.assertEqual(stats['workers'], 2)
+        self.assertEqual(stats['spawned'], 2)
+        self.assertEqual(stats['spawn_latency']['count'], 2)
+        self.assertTrue(stats['spawn_latency']['max'] > 0)
+
+    def test_failures(self):
+        with self.assertRaises(WorkerError) as cm:
+            self.pool.map('loadsbase.tests.test_workers.fail', [()],
+                          timeout=10)
+        self.assertTrue('ValueError: boom' in str(cm.exception))
+        self.assertRaises(WorkerError, self.pool.map, 'loadsbase.nope', [()],
+                          timeout=10)
+
+    def test_restart(self):
+        job_id = self.pool.submit('loadsbase.tests.test_workers.crash')
+        deadline = time.time() + 10
+        results = []
+        while not results and time.time() < deadline:
+            results = self.pool.poll(1.)
+        self.assertEqual(results, [(job_id, False,
+                                    'The worker died with status 768')])
+
+        # the worker was replaced
+        self.assertEqual(self.pool.restarts, 1)
+        self.assertEqual(len(self.pool), 2)
+        res = self.pool.map('loadsbase.tests.test_workers.add',
+                            [(i, i) for i in range(4)], timeout=10)
+        self.assertEqual(res, [0, 2, 4, 6])
+
+        # the other worker may run all the jobs before the new one is ready
+        while (self.pool.stats()['spawn_latency']['count'] < 3 and
+               time.time() < deadline):
+            self.pool.poll(0.1)
+        self.assertEqual(self.pool.stats()['spawn_latency']['count'], 3)
+
+    def test_stop(self):
+        pids = [worker.pid for worker in self.pool._workers.values()]
+        self.pool.stop()
+        for pid in pids:
+            self.assertRaises(OSError, os.kill, pid, 0)
+        self.assertFalse(os.path.exists(self.pool.endpoint[len('ipc://'):]))
+
+    def test_two_pools(self):
+        other = WorkerPool(size=1)
+        self.assertNotEqual(other.endpoint, self.pool.endpoint)
+        other.start()
+        try:
+            self.assertEqual(other.map('loadsbase.tests.test_workers.add',
+                                       [(1, 2)], timeout=10), [3])
+            self.assertEqual(self.pool.map('loadsbase.tests.test_workers.add',
+                                           [(2, 2)], timeout=10), [4])
+        finally:
+            other.stop()
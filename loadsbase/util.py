@@ -1,21 +1,53 @@
 import logging
-from logging import handlers
 import os
 import sys
-import time
 import socket
-import zipfile
-from StringIO import StringIO
 import json
-import urlparse
 import math
 import datetime
-import fnmatch
-import hashlib
-import random
+import re
+import array
+import functools
+import time
+import itertools
+import threading
+import types
+import zlib
+
+from loadsbase.clock import monotonic
+from loadsbase.stats import Histogram, timers  # NOQA
 
 logger = logging.getLogger('loads')
 
+# the modules which are optional, or slow to import and rarely needed, are
+# imported when they are first used, so starting a process which only needs
+# a few helpers stays fast
+_OPTIONAL = {}
+
+
+def _optional_import(name):
+    # returns the module, or None if it's not installed
+    try:
+        return _OPTIONAL[name]
+    except KeyError:
+        pass
+    try:
+        __import__(name)
+        module = sys.modules[name]
+    except ImportError:
+        module = None
+    _OPTIONAL[name] = module
+    return module
+
+
+def _get_scandir():
+    scandir = getattr(os, 'scandir', None)
+    if scandir is None:
+        module = _optional_import('scandir')
+        if module is not None:
+            scandir = module.scandir
+    return scandir
+
 
 def total_seconds(td):
     # works for 2.7 and 2.6
@@ -33,7 +65,21 @@ class DateTimeJSONEncoder(json.JSONEncoder):
             return super(DateTimeJSONEncoder, self).default(obj)
 
 
-def set_logger(debug=False, name='loads', logfile='stdout'):
+def set_logger(debug=False, name='loads', logfile='stdout',
+               background=False, queue_size=10000, max_bytes=10 * 1024 * 1024,
+               backup_count=5):
+    """Sets up the *name* logger to log to the standard output or to
+    *logfile*.
+
+    Log files are rotated when they reach *max_bytes*, keeping
+    *backup_count* old files. When *background* is True, the records are
+    written by a background thread, see
+    :class:`loadsbase.logs.BackgroundHandler`.
+
+    Returns the added handler.
+    """
+    from logging import handlers
+
     # setting up the logger
     logger_ = logging.getLogger(name)
     logger_.setLevel(logging.DEBUG)
@@ -41,15 +87,26 @@ def set_logger(debug=False, name='loads', logfile='stdout'):
     if logfile == 'stdout':
         ch = logging.StreamHandler()
     else:
-        ch = handlers.RotatingFileHandler(logfile, mode='a+')
+        ch = handlers.RotatingFileHandler(logfile, mode='a+',
+                                          maxBytes=max_bytes,
+                                          backupCount=backup_count)
 
     if debug:
-        ch.setLevel(logging.DEBUG)
+        level = logging.DEBUG
     else:
-        ch.setLevel(logging.INFO)
+        level = logging.INFO
+    ch.setLevel(level)
 
     formatter = logging.Formatter('[%(asctime)s][%(process)d] %(message)s')
     ch.setFormatter(formatter)
+
+    if background:
+        from loadsbase.logs import BackgroundHandler
+
+        ch = BackgroundHandler([ch], queue_size=queue_size)
+        # filters the records before they are queued
+        ch.setLevel(level)
+
     logger_.addHandler(ch)
 
     # for the tests
@@ -59,6 +116,128 @@ def set_logger(debug=False, name='loads', logfile='stdout'):
         fh.setFormatter(formatter)
         logger.addHandler(fh)
 
+    return ch
+
+
+class _CallSite(object):
+    __slots__ = ('calls', 'tokens', 'refilled', 'suppressed', 'since')
+
+    def __init__(self, tokens, now):
+        self.calls = 0
+        self.tokens = tokens
+        self.refilled = self.since = now
+        self.suppressed = 0
+
+
+class ThrottledLogger(object):
+    """Limits how often each message is logged, so debug logging can stay on
+    in hot paths.
+
+    Calls are throttled per call site, identified by their message format
+    (not the formatted message) or by an explicit *key* argument. A call
+    can be sampled (only 1 in *every* is logged) and rate-limited with a
+    token bucket. The suppressed calls are counted and reported every
+    *window* seconds, like::
+
+        'Invalid beat timestamp %r' repeated 4512 times in the last 10s
+
+    The report is logged by the next call of the site once the window has
+    elapsed, or by :meth:`flush`. Counters are not locked, so they may be
+    slightly off when several threads log the same message.
+
+    Options:
+
+    - **logger**: the logger. Defaults to the loads logger.
+    - **every**: logs one call in *every*. Defaults to 1.
+    - **rate**: the maximum number of calls logged per second, per site.
+      Defaults to None (no limit).
+    - **burst**: the number of calls that can be logged at once, before
+      *rate* applies. Defaults to *rate*, or 1.
+    - **window**: the interval of the reports of suppressed calls, in
+      seconds. Defaults to 10. None disables the reports.
+    - **clock**: the callable used to get the current time.
+    """
+    def __init__(self, logger=None, every=1, rate=None, burst=None,
+                 window=10., clock=monotonic):
+        if logger is None:
+            logger = logging.getLogger('loads')
+        if burst is None:
+            burst = max(rate or 1, 1)
+        self.logger = logger
+        self.every = every
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.clock = clock
+        self._sites = {}
+
+    def log(self, level, msg, *args, **kw):
+        """Logs *msg* % *args* at *level*, unless the call is suppressed.
+
+        Returns True if the message was logged.
+        """
+        logger_ = self.logger
+        if not logger_.isEnabledFor(level):
+            return False
+
+        key = kw.pop('key', msg)
+        now = self.clock()
+        site = self._sites.get(key)
+        if site is None:
+            site = self._sites[key] = _CallSite(self.burst, now)
+
+        site.calls += 1
+        allowed = self.every == 1 or site.calls % self.every == 1
+
+        if allowed and self.rate is not None:
+            tokens = min(self.burst,
+                         site.tokens + (now - site.refilled) * self.rate)
+            site.refilled = now
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                allowed = False
+            site.tokens = tokens
+
+        if not allowed:
+            site.suppressed += 1
+
+        if self.window is not None and now - site.since >= self.window:
+            self._report(level, key, site, now)
+
+        if allowed:
+            logger_.log(level, msg, *args, **kw)
+        return allowed
+
+    def _report(self, level, key, site, now):
+        if site.suppressed:
+            self.logger.log(level, '%r repeated %d times in the last %.0fs',
+                            key, site.suppressed, now - site.since)
+            site.suppressed = 0
+        site.since = now
+
+    def flush(self, level=logging.DEBUG):
+        """Reports the calls suppressed so far, at *level*."""
+        now = self.clock()
+        for key, site in self._sites.items():
+            self._report(level, key, site, now)
+
+    def debug(self, msg, *args, **kw):
+        return self.log(logging.DEBUG, msg, *args, **kw)
+
+    def info(self, msg, *args, **kw):
+        return self.log(logging.INFO, msg, *args, **kw)
+
+    def warning(self, msg, *args, **kw):
+        return self.log(logging.WARNING, msg, *args, **kw)
+
+    def error(self, msg, *args, **kw):
+        return self.log(logging.ERROR, msg, *args, **kw)
+
+
+# used for the debug messages of the hot paths
+throttled_logger = ThrottledLogger(rate=10.)
+
 
 GIGA = 1024. * 1024. * 1024.
 # let's just make the assumption it won't change
@@ -73,10 +252,8 @@ def get_hostname():
     return _HOST
 
 
-if sys.platform == "win32":
-    timer = time.clock      # pragma: nocover
-else:
-    timer = time.time
+# timer is used to measure durations, see loadsbase.clock.monotonic
+timer = monotonic
 
 
 def decode_params(params):
@@ -102,8 +279,63 @@ def encode_params(intput_dict):
     return '|'.join([':'.join(i) for i in intput_dict.items()])
 
 
-def timed(debug=False):
+def timed(debug=False, window=None, name=None, registry=None):
+    """Decorator returning the duration of each call along with its result.
+
+    If *debug* is True, the durations are logged with
+    :data:`throttled_logger`, so at most 10 per second for each decorated
+    function.
+
+    If a *window* is provided, like a :class:`loadsbase.stats.RollingWindow`,
+    each duration is also added to it.
+
+    If a *name* is provided, the decorated function keeps its return value
+    and the durations are recorded into the timer of that name of the
+    *registry* (defaults to :data:`loadsbase.stats.timers`), which can be
+    read with its snapshot() method. *debug* and *window* still apply. The
+    timer is created once, when the function is decorated, but recording
+    is not free: :meth:`loadsbase.stats.Histogram.add` takes about 1.3us
+    on CPython 2.7, so this mode costs more per call than timed() alone,
+    see benchmarks/bench_timed.py.
+    """
+    if name is not None:
+        if registry is None:
+            registry = timers
+        record = registry.get(name).record
+
+        def _named_timed(func):
+            key = '%s.%s' % (func.__module__, func.__name__)
+
+            if not debug and window is None:
+                @functools.wraps(func)
+                def __timed(*args, **kw):
+                    start = timer()
+                    try:
+                        return func(*args, **kw)
+                    finally:
+                        record(timer() - start)
+                return __timed
+
+            @functools.wraps(func)
+            def __timed(*args, **kw):
+                start = timer()
+                try:
+                    return func(*args, **kw)
+                finally:
+                    duration = timer() - start
+                    record(duration)
+                    if debug:
+                        throttled_logger.debug('%s took %.4fs', key,
+                                               duration, key=key)
+                    if window is not None:
+                        window.add(duration)
+            return __timed
+        return _named_timed
+
     def _timed(func):
+        # the messages of each function are throttled separately
+        key = '%s.%s' % (func.__module__, func.__name__)
+
         def __timed(*args, **kw):
             start = timer()
             try:
@@ -111,25 +343,88 @@ def timed(debug=False):
             finally:
                 duration = timer() - start
                 if debug:
-                    logger.debug('%.4f' % duration)
+                    throttled_logger.debug('%s took %.4fs', key, duration,
+                                           key=key)
+                if window is not None:
+                    window.add(duration)
             return duration, res
         return __timed
     return _timed
 
 
+class ParsedURL(object):
+    """The parts of a URL or of a ZMQ endpoint.
+
+    Exposes the **scheme**, **netloc**, **host**, **port** and **path** of
+    the url. The port defaults to 80. Use :func:`parse_url` to get instances
+    of this class, since it caches them.
+    """
+    __slots__ = ('url', 'scheme', 'netloc', 'host', '_port', 'path', '_head',
+                 '_tail')
+
+    def __init__(self, url):
+        import urlparse
+
+        self.url = url
+        parts = urlparse.urlparse(url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.path = parts.path
+
+        netloc = parts.netloc.rsplit(':')
+        if len(netloc) == 1:
+            netloc.append('80')
+        self.host = netloc[0]
+        self._port = netloc[1]
+
+        # what comes before and after the location, to rebuild the url
+        self._head = parts.scheme + '://'
+        self._tail = urlparse.urlunparse(('', '') + parts[2:])
+
+    @property
+    def port(self):
+        return int(self._port)
+
+    def with_host(self, host):
+        """Returns the url, with its host replaced by *host*, like a
+        resolved IP address. The port is always included."""
+        return self._head + host + ':' + self._port + self._tail
+
+
+_URL_CACHE = {}
+_URL_CACHE_SIZE = 4096
+
+
+def parse_url(url):
+    """Returns the :class:`ParsedURL` of *url*.
+
+    The results are cached, up to a few thousands urls.
+    """
+    try:
+        return _URL_CACHE[url]
+    except KeyError:
+        pass
+
+    parsed = ParsedURL(url)
+    if len(_URL_CACHE) >= _URL_CACHE_SIZE:
+        try:
+            _URL_CACHE.popitem()
+        except KeyError:
+            pass
+    _URL_CACHE[url] = parsed
+    return parsed
+
+
 def split_endpoint(endpoint):
     """Returns the scheme, the location, and maybe the port.
     """
     res = {}
-    parts = urlparse.urlparse(endpoint)
+    parts = parse_url(endpoint)
     res['scheme'] = parts.scheme
 
     if parts.scheme == 'tcp':
-        netloc = parts.netloc.rsplit(':')
-        if len(netloc) == 1:
-            netloc.append('80')
-        res['ip'] = netloc[0]
-        res['port'] = int(netloc[1])
+        res['ip'] = parts.host
+        res['port'] = parts.port
     elif parts.scheme == 'ipc':
         res['path'] = parts.path
     else:
@@ -138,7 +433,32 @@ def split_endpoint(endpoint):
     return res
 
 
-_DNS_CACHE = {}
+# the DNS cache and selector are created when they are first needed
+_DNS_CACHE = None
+_DNS_SELECTOR = None
+_DNS_LOCK = threading.Lock()
+
+
+def _get_dns_cache():
+    global _DNS_CACHE
+    if _DNS_CACHE is None:
+        from loadsbase.dns import DNSCache
+
+        with _DNS_LOCK:
+            if _DNS_CACHE is None:
+                _DNS_CACHE = DNSCache()
+    return _DNS_CACHE
+
+
+def _get_dns_selector():
+    global _DNS_SELECTOR
+    if _DNS_SELECTOR is None:
+        from loadsbase.dns import AddressSelector
+
+        with _DNS_LOCK:
+            if _DNS_SELECTOR is None:
+                _DNS_SELECTOR = AddressSelector()
+    return _DNS_SELECTOR
 
 
 def null_streams(streams):
@@ -165,22 +485,94 @@ def null_streams(streams):
         os.close(devnull)
 
 
-def dict_hash(data, omit_keys=None):
+def _encode_canonical(value, out):
+    # appends to out a type-tagged encoding of value, which doesn't depend on
+    # the order of the mappings and sets
+    if value is None:
+        out.append('N')
+    elif value is True:
+        out.append('T')
+    elif value is False:
+        out.append('F')
+    elif isinstance(value, (int, long)):
+        out.append('i%d;' % value)
+    elif isinstance(value, float):
+        out.append('f%r;' % value)
+    elif isinstance(value, basestring):
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        out.append('s%d:' % len(value))
+        out.append(value)
+    elif isinstance(value, (list, tuple)):
+        out.append('l')
+        for item in value:
+            _encode_canonical(item, out)
+        out.append('e')
+    elif isinstance(value, dict):
+        items = []
+        for key, item in value.items():
+            encoded = []
+            _encode_canonical(key, encoded)
+            _encode_canonical(item, encoded)
+            items.append(''.join(encoded))
+        items.sort()
+        out.append('d')
+        out.extend(items)
+        out.append('e')
+    elif isinstance(value, (set, frozenset)):
+        items = []
+        for item in value:
+            encoded = []
+            _encode_canonical(item, encoded)
+            items.append(''.join(encoded))
+        items.sort()
+        out.append('S')
+        out.extend(items)
+        out.append('e')
+    else:
+        out.append('o')
+        _encode_canonical(str(value), out)
+
+
+_HASH_CACHE = {}
+_HASH_CACHE_SIZE = 1024
+
+
+def dict_hash(data, omit_keys=None, memoize=False):
     """Useful to identify a data mapping.
+
+    The hash only depends on the content of the mapping: the keys are
+    sorted, and the nested lists, mappings and sets are hashed recursively,
+    along with the type of every value. So the same data gets the same hash
+    in every process.
+
+    If *memoize* is True, the hashes are cached using the repr of the data
+    as a key. This should only be used with data made of builtin types.
     """
+    import hashlib
+
     if omit_keys is None:
         omit_keys = []
 
-    hash = hashlib.md5()
+    if memoize:
+        cache_key = repr(data), tuple(omit_keys)
+        res = _HASH_CACHE.get(cache_key)
+        if res is not None:
+            return res
 
-    for key, value in data.items():
-        if key in omit_keys:
-            continue
-        hash.update(str(key))
-        hash.update(str(value))
-        hash.update('ENDMARKER')
+    if omit_keys:
+        data = dict((key, value) for key, value in data.items()
+                    if key not in omit_keys)
 
-    return hash.hexdigest()
+    out = []
+    _encode_canonical(data, out)
+    res = hashlib.md5(''.join(out)).hexdigest()
+
+    if memoize:
+        if len(_HASH_CACHE) >= _HASH_CACHE_SIZE:
+            _HASH_CACHE.clear()
+        _HASH_CACHE[cache_key] = res
+    return res
 
 
 def dns_resolve(url):
@@ -191,27 +583,84 @@ def dns_resolve(url):
     the original hostname string, and the resolved IP addr string.
 
     The results of DNS resolution are cached to make sure this doesn't become
-    a bottleneck for the loadtest.  If the hostname resolves to multiple
-    addresses then a random address is chosen.
+    a bottleneck for the loadtest, see :class:`loadsbase.dns.DNSCache`.  If
+    the hostname resolves to multiple addresses then one of them is chosen by
+    the selector set with :func:`set_dns_selector` (by default, a random
+    one). Use :func:`dns_report_failure` and :func:`dns_report_success` to
+    let the selector know how the chosen address behaves.
     """
-    parts = urlparse.urlparse(url)
-    netloc = parts.netloc.rsplit(':')
-    if len(netloc) == 1:
-        netloc.append('80')
+    parts = parse_url(url)
+    original = parts.host
+    addrs = _get_dns_cache().resolve(original)
 
-    original = netloc[0]
-    addrs = _DNS_CACHE.get(original)
-    if addrs is None:
-        addrs = socket.gethostbyname_ex(original)[2]
-        _DNS_CACHE[original] = addrs
+    resolved = _get_dns_selector().select(original, addrs)
+    return parts.with_host(resolved), original, resolved
 
-    resolved = random.choice(addrs)
-    netloc = resolved + ':' + netloc[1]
-    parts = (parts.scheme, netloc) + parts[2:]
-    return urlparse.urlunparse(parts), original, resolved
 
+def set_dns_cache(cache):
+    """Sets the :class:`loadsbase.dns.DNSCache` used by :func:`dns_resolve`.
 
-# taken from distutils2
+    Use a :class:`loadsbase.dns.SharedDNSCache` to share the resolutions
+    between the worker processes of a machine.
+    """
+    global _DNS_CACHE
+    _DNS_CACHE = cache
+
+
+def set_dns_selector(selector):
+    """Sets the :class:`loadsbase.dns.AddressSelector` used by
+    :func:`dns_resolve` to pick one of the addresses of a host."""
+    global _DNS_SELECTOR
+    _DNS_SELECTOR = selector
+
+
+def dns_report_failure(resolved):
+    """Reports a connection failure to an address returned by
+    :func:`dns_resolve`."""
+    _get_dns_selector().report_failure(resolved)
+
+
+def dns_report_success(resolved, latency=None):
+    """Reports a successful call to an address returned by
+    :func:`dns_resolve`, and optionally its latency in seconds."""
+    _get_dns_selector().report_success(resolved, latency)
+
+
+def dns_prefetch(urls, workers=10):
+    """Resolves the hostnames of the given urls concurrently, and stores the
+    results in the cache used by :func:`dns_resolve`.
+
+    This is useful to warm up the cache before a load test starts, so the
+    first requests don't pay for a blocking DNS resolution. Returns the
+    report of :func:`loadsbase.dns.prefetch`.
+    """
+    from loadsbase.dns import prefetch
+
+    hosts = [parse_url(url).host for url in urls]
+    report = prefetch(hosts, _get_dns_cache(), workers)
+    logger.debug('DNS prefetch of %d hosts took %.4fs' % (
+        len(report['resolved']) + len(report['failed']), report['duration']))
+    return report
+
+
+_RESOLVED = {}
+_PATH_LOCK = threading.Lock()
+
+
+def _add_current_dir():
+    # Depending how loads is ran, "" can or cannot be present in the path. This
+    # adds it if it's missing.
+    with _PATH_LOCK:
+        if len(sys.path) < 1 or sys.path[0] not in ('', os.getcwd()):
+            sys.path.insert(0, '')
+
+
+def _import(name):
+    __import__(name)
+    return sys.modules[name]
+
+
+# adapted from distutils2
 def resolve_name(name):
     """Resolve a name like ``module.object`` to an object and return it.
 
@@ -220,51 +669,69 @@ def resolve_name(name):
     However, looking up builtins is not directly supported: use
     ``__builtin__.name``.
 
+    Resolved names are cached, so further calls don't import anything.
+    This function is thread-safe.
+
     Raises ImportError if importing the module fails or if one requested
     attribute is not found.
     """
+    try:
+        return _RESOLVED[name]
+    except KeyError:
+        pass
 
-    # Depending how loads is ran, "" can or cannot be present in the path. This
-    # adds it if it's missing.
-    if len(sys.path) < 1 or sys.path[0] not in ('', os.getcwd()):
-        sys.path.insert(0, '')
-
-    if '.' not in name:
-        # shortcut
-        __import__(name)
-        return sys.modules[name]
-
-    # FIXME clean up this code!
+    _add_current_dir()
     parts = name.split('.')
-    cursor = len(parts)
-    module_name = parts[:cursor]
-    ret = ''
-
-    while cursor > 0:
-        try:
-            ret = __import__('.'.join(module_name))
-            break
-        except ImportError:
-            cursor -= 1
-            module_name = parts[:cursor]
-
-    if ret == '':
-        raise ImportError(parts[0])
+    ret = _import(parts[0])
 
-    for part in parts[1:]:
+    # the name is walked from the top-level module: each part is an
+    # attribute, or a submodule that is imported if it's not an attribute
+    for index, part in enumerate(parts[1:], 2):
         try:
             ret = getattr(ret, part)
         except AttributeError, exc:
-            raise ImportError(exc)
+            if not isinstance(ret, types.ModuleType):
+                raise ImportError(exc)
+            ret = _import('.'.join(parts[:index]))
 
+    _RESOLVED[name] = ret
     return ret
 
 
-def get_quantiles(data, quantiles):
+def _quantile_positions(quantiles, data_len):
+    """Returns, for each quantile, the index in the sorted data and the
+    interpolation weight to apply with the next value (Hyndman and Fan
+    definition 8)."""
+    a, b, c, d = (1.0 / 3, 1.0 / 3, 0, 1)
+    positions = []
+
+    for q in quantiles:
+        g, j = math.modf(a + (data_len + b) * q - 1)
+        if j < 0:
+            positions.append((0, 0))
+            continue
+        elif j >= data_len:
+            positions.append((data_len - 1, 0))
+            continue
+        j = int(math.floor(j))
+
+        if g == 0 or j == data_len - 1:
+            positions.append((j, 0))
+        else:
+            positions.append((j, c + d * g))
+
+    return positions
+
+
+def get_quantiles(data, quantiles, overwrite_input=False):
     """Computes the quantiles for the data array you pass along.
 
     :param data: the input array
     :param quantiles: a list of quantiles you want to compute.
+    :param overwrite_input: if True and *data* is a numpy array or an
+                            :class:`array.array`, it is partially sorted
+                            in place instead of being copied, so the
+                            order of its values changes.
 
     This is an adapted version of an implementation by Ernesto P.Adorio Ph.D.
     UP Extension Program in Pampanga, Clark Field.
@@ -273,30 +740,53 @@ def get_quantiles(data, quantiles):
     depending on scipy, who have a much better and faster version, see
     scipy.stats.mstats.mquantiles
 
+    When numpy is installed and *data* is a numpy array or an
+    :class:`array.array`, all the quantiles are selected in a single
+    partition pass instead of sorting a copy of the whole data set.
+
+    The result is exact, but otherwise the whole data set is copied and
+    sorted. When dealing with millions of values, prefer an approximation using
+    :class:`loadsbase.stats.QuantileSketch`.
+
     References:
        http://reference.wolfram.com/mathematica/ref/Quantile.html
        http://wiki.r-project.org/rwiki/doku.php?id=rdoc:stats:quantile
        http://adorio-research.org/wordpress/?p=125
 
     """
-    def _get_quantile(q, data_len):
-        a, b, c, d = (1.0 / 3, 1.0 / 3, 0, 1)
-        g, j = math.modf(a + (data_len + b) * q - 1)
-        if j < 0:
-                return data[0]
-        elif j >= data_len:
-                return data[data_len - 1]
-        j = int(math.floor(j))
+    # a numpy array can't exist if numpy was not imported yet
+    numpy = sys.modules.get('numpy')
+    if numpy is None and isinstance(data, array.array):
+        numpy = _optional_import('numpy')
+
+    if numpy is not None and isinstance(data, (array.array, numpy.ndarray)):
+        if isinstance(data, array.array):
+            # a writeable view, so the array is partitioned in place too
+            data = numpy.frombuffer(data, dtype=data.typecode)
+        data = data.ravel()
+        if not overwrite_input or not data.flags.writeable:
+            data = data.copy()
+        positions = _quantile_positions(quantiles, len(data))
+
+        kth = set()
+        for j, g in positions:
+            kth.add(j)
+            if g:
+                kth.add(j + 1)
+        data.partition(sorted(kth))
+    else:
+        data = sorted(data)
+        positions = _quantile_positions(quantiles, len(data))
 
-        if g == 0 or j == len(data) - 1:
+    def _get_quantile(j, g):
+        if g == 0:
             return data[j]
-        else:
-            return data[j] + (data[j + 1] - data[j]) * (c + d * g)
+        return data[j] + (data[j + 1] - data[j]) * g
 
-    data = sorted(data)
-    data_len = len(data)
-
-    return [_get_quantile(q, data_len) for q in quantiles]
+    res = [_get_quantile(j, g) for j, g in positions]
+    if numpy is not None and isinstance(data, numpy.ndarray):
+        res = [value.item() for value in res]
+    return res
 
 
 def try_import(*packages):
@@ -311,70 +801,655 @@ def try_import(*packages):
         raise ImportError('You need to run "pip install %s"' % failed_packages)
 
 
-def glob(patterns, location='.'):
+class DirectoryListing(object):
+    """Caches the content of the directories, for the duration of a glob.
+
+    Calling the listing with a directory path returns a list of
+    (name, is_dir, is_symlink) tuples. When available, scandir is used, so
+    the types come from the directory entries without extra stat calls.
+    Directories which can't be listed are considered empty.
+    """
+    def __init__(self):
+        self._cache = {}
+
+    def __call__(self, path):
+        entries = self._cache.get(path)
+        if entries is not None:
+            return entries
+
+        scandir = _get_scandir()
+        try:
+            if scandir is not None:
+                entries = [(entry.name, entry.is_dir(), entry.is_symlink())
+                           for entry in scandir(path)]
+            else:
+                entries = []
+                for name in os.listdir(path):
+                    fullpath = os.path.join(path, name)
+                    entries.append((name, os.path.isdir(fullpath),
+                                    os.path.islink(fullpath)))
+        except OSError:
+            entries = []
+
+        self._cache[path] = entries
+        return entries
+
+    def walk_files(self, path):
+        """Yields the path of all the files under *path*, like os.walk."""
+        dirs = []
+        for name, is_dir, is_symlink in self(path):
+            if not is_dir:
+                yield os.path.join(path, name)
+            elif not is_symlink:
+                dirs.append(name)
+        for name in dirs:
+            for filepath in self.walk_files(os.path.join(path, name)):
+                yield filepath
+
+
+_MAGIC = re.compile('[*?[]')
+_PATTERNS = {}
+
+
+def _compile_pattern(pattern):
+    # returns the list of components of a glob pattern: '**', a literal
+    # name, or a compiled regular expression
+    import fnmatch
+
+    parts = _PATTERNS.get(pattern)
+    if parts is None:
+        parts = []
+        for part in pattern.split('/'):
+            if part == '**' or not _MAGIC.search(part):
+                parts.append(part)
+            else:
+                parts.append(re.compile(fnmatch.translate(part)))
+        _PATTERNS[pattern] = parts
+    return parts
+
+
+def _glob(basedir, parts, listing, seen):
+    if not parts:
+        if basedir not in seen:
+            seen.add(basedir)
+            yield basedir
+        return
+
+    part, rest = parts[0], parts[1:]
+
+    if part == '**':
+        # zero or more directories
+        for path in _glob(basedir, rest, listing, seen):
+            yield path
+        for name, is_dir, is_symlink in listing(basedir):
+            if is_dir and not is_symlink:
+                for path in _glob(os.path.join(basedir, name), parts,
+                                  listing, seen):
+                    yield path
+    elif not isinstance(part, basestring):
+        for name, is_dir, is_symlink in listing(basedir):
+            if part.match(name) and (is_dir or not rest):
+                for path in _glob(os.path.join(basedir, name), rest,
+                                  listing, seen):
+                    yield path
+    elif part in ('', '.'):
+        for path in _glob(basedir, rest, listing, seen):
+            yield path
+    else:
+        subpath = os.path.join(basedir, part)
+        if rest or os.path.lexists(subpath):
+            for path in _glob(subpath, rest, listing, seen):
+                yield path
+
+
+def glob(patterns, location='.', listing=None):
+    """Yields the absolute paths matching the given glob patterns.
+
+    The patterns are relative to *location* and use the fnmatch syntax. A
+    ``**`` component matches any number of directories, including none.
+
+    The directories are only listed once, even when several patterns need
+    them: pass a :class:`DirectoryListing` as *listing* to share the
+    listings with other calls.
+    """
+    if listing is None:
+        listing = DirectoryListing()
+
+    location = os.path.abspath(location)
     for pattern in patterns:
-        basedir, pattern = os.path.split(pattern)
-        basedir = os.path.abspath(os.path.join(location, basedir))
-        for file_ in os.listdir(basedir):
-            if fnmatch.fnmatch(file_, pattern):
-                yield os.path.join(basedir, file_)
+        if os.path.isabs(pattern):
+            basedir = '/'
+        else:
+            basedir = location
+        parts = _compile_pattern(pattern.strip('/'))
+        for path in _glob(basedir, parts, listing, set()):
+            yield os.path.normpath(path)
+
+
+# the size of the chunks produced by pack_include_chunks
+CHUNK_SIZE = 1024 * 1024
+
+
+def _in_walked(path, walked):
+    # True if *path* or one of its parents is in *walked*
+    while path not in walked:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+    return True
+
+
+def _iter_include_files(include_files, location):
+    # yields the name in the bundle and the path of every included file.
+    # The names are relative to the directory of the pattern which matched,
+    # which is the part of the pattern before its first wildcard. A name is
+    # only yielded once, even if several patterns or directories match it.
+    listing = DirectoryListing()
+    names = set()
+    for pattern in include_files:
+        parts = pattern.split('/')[:-1]
+        for index, part in enumerate(parts):
+            if part == '**' or _MAGIC.search(part):
+                parts = parts[:index]
+                break
+        # like glob(), absolute patterns don't depend on the location
+        if os.path.isabs(pattern):
+            basedir = os.path.join('/', *parts)
+        else:
+            basedir = os.path.join(os.path.abspath(location), *parts)
+        basedir = os.path.normpath(basedir)
+
+        walked = set()
+        for basepath in glob([pattern], location, listing):
+            if not os.path.isdir(basepath):
+                filepaths = [basepath]
+            elif _in_walked(basepath, walked):
+                # a '**' pattern also matches the subdirectories of the
+                # directories it matched
+                continue
+            else:
+                walked.add(basepath)
+                filepaths = listing.walk_files(basepath)
+
+            for filepath in filepaths:
+                name = os.path.relpath(filepath, basedir)
+                if name not in names:
+                    names.add(name)
+                    yield name, filepath
+
+
+def file_hash(filepath):
+    """Returns the SHA1 hex digest of the content of a file."""
+    import hashlib
+
+    hash = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hash.update(chunk)
+    return hash.hexdigest()
+
 
+def get_include_manifest(include_files, location='.'):
+    """Returns the manifest of the specified include_files.
 
-def pack_include_files(include_files, location='.'):
+    The manifest maps the name of every file in the bundle to a list
+    containing the hash of its content and its mode. It can be serialized in
+    JSON, and used with an :class:`IncludeFilesCache` to only ship the files
+    an agent does not have yet.
+    """
+    manifest = {}
+    for name, filepath in _iter_include_files(include_files, location):
+        manifest[name] = [file_hash(filepath), os.stat(filepath).st_mode]
+    return manifest
+
+
+class IncludeFilesCache(object):
+    """A content-addressed cache of include files, stored in *path*.
+
+    This is used by agents to avoid receiving files they already have:
+
+    1. the broker sends the manifest of the bundle, built with
+       get_include_manifest().
+    2. the agent answers with the hashes returned by :meth:`missing`.
+    3. the broker only packs these files, by passing them as the *hashes*
+       option of pack_include_files() & co.
+    4. the agent unpacks the bundle with the manifest and this cache, and
+       the files which were not shipped are restored from the cache.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, hash):
+        return os.path.join(self.path, hash[:2], hash)
+
+    def __contains__(self, hash):
+        return os.path.exists(self._path(hash))
+
+    def missing(self, manifest):
+        """Returns the sorted list of hashes of the manifest which are not
+        in the cache."""
+        hashes = set(hash for hash, mode in manifest.values())
+        return sorted(hash for hash in hashes if hash not in self)
+
+    def add(self, filepath, hash=None):
+        """Copies a file in the cache. Returns its hash."""
+        import shutil
+
+        if hash is None:
+            hash = file_hash(filepath)
+        target = self._path(hash)
+        if not os.path.exists(target):
+            maybe_makedirs(os.path.dirname(target))
+            # copy then rename, so a concurrent reader never sees a partial
+            # file
+            tmp = '%s.%d' % (target, os.getpid())
+            shutil.copyfile(filepath, tmp)
+            os.rename(tmp, target)
+        return hash
+
+    def restore(self, hash, filepath, mode=None):
+        """Copies the file of the given hash from the cache to *filepath*."""
+        import shutil
+
+        maybe_makedirs(os.path.dirname(filepath))
+        shutil.copyfile(self._path(hash), filepath)
+        if mode:
+            os.chmod(filepath, mode)
+
+
+# files with these extensions are already compressed, and are stored as-is
+# in the bundles
+STORED_EXTENSIONS = ('.gz', '.tgz', '.bz2', '.xz', '.zip', '.jar', '.7z',
+                     '.png', '.jpg', '.jpeg', '.gif', '.mp3', '.mp4')
+
+
+def _compress_file(args):
+    import tempfile
+    import zipfile
+
+    # compresses a file into a temporary file of *tmpdir*, by chunks.
+    # Returns the CRC, the sizes and the path of the temporary file. This
+    # runs in the processes of the pool used by write_include_files.
+    filepath, compress_type, level, tmpdir = args
+    crc = size = 0
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    else:
+        compressor = None
+
+    fd, tmp = tempfile.mkstemp(prefix='loads-', dir=tmpdir)
+    with os.fdopen(fd, 'wb') as target:
+        with open(filepath, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                crc = zlib.crc32(chunk, crc)
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                target.write(chunk)
+        if compressor is not None:
+            target.write(compressor.flush())
+        compressed_size = target.tell()
+
+    return crc & 0xffffffff, size, compressed_size, tmp
+
+
+def _write_compressed(zf, name, filepath, compress_type, compressed):
+    import shutil
+    import zipfile
+
+    # adds a member compressed by _compress_file to the archive, the same way
+    # ZipFile.writestr does. zipfile has no public API to add data which is
+    # already compressed, so this relies on its internals: _writecheck,
+    # _didModify, filelist, NameToInfo and FileHeader, which takes the zip64
+    # flag since Python 2.7 and computes it on Python 2.6. Check them when
+    # supporting a new Python version.
+    crc, size, compressed_size, tmp = compressed
+    try:
+        st = os.stat(filepath)
+        zinfo = zipfile.ZipInfo(name, time.localtime(st.st_mtime)[:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+        zinfo.compress_type = compress_type
+        zinfo.file_size = size
+        zinfo.compress_size = compressed_size
+        zinfo.CRC = crc
+        zinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        if sys.version_info < (2, 7):
+            header = zinfo.FileHeader()
+        else:
+            zip64 = (size > zipfile.ZIP64_LIMIT or
+                     compressed_size > zipfile.ZIP64_LIMIT)
+            header = zinfo.FileHeader(zip64)
+        zf.fp.write(header)
+        with open(tmp, 'rb') as f:
+            shutil.copyfileobj(f, zf.fp, CHUNK_SIZE)
+        zf.fp.flush()
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+    finally:
+        os.remove(tmp)
+
+
+def _zip_include_files(zf, include_files, location, hashes=None,
+                       manifest=None, workers=None, level=None,
+                       stored_extensions=STORED_EXTENSIONS):
+    import multiprocessing
+    import shutil
+    import tempfile
+    import zipfile
+
+    if hashes is not None:
+        hashes = set(hashes)
+
+    members = []
+    for name, filepath in _iter_include_files(include_files, location):
+        if hashes is not None:
+            if manifest is not None and name in manifest:
+                hash = manifest[name][0]
+            else:
+                hash = file_hash(filepath)
+            if hash not in hashes:
+                continue
+
+        if os.path.splitext(name)[1].lower() in stored_extensions:
+            compress_type = zipfile.ZIP_STORED
+        else:
+            compress_type = zipfile.ZIP_DEFLATED
+        members.append((name, filepath, compress_type))
+
+    if not workers and level is None:
+        # the files are read by chunks by ZipFile.write, so they are never
+        # loaded in memory
+        for name, filepath, compress_type in members:
+            zf.write(filepath, name, compress_type)
+        return
+
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+
+    # the workers compress ahead of the writes, so if a write fails the
+    # temporary files of the next members are removed with their directory
+    tmpdir = tempfile.mkdtemp(prefix='loads-')
+    jobs = [(filepath, compress_type, level, tmpdir)
+            for name, filepath, compress_type in members]
+    pool = None
+    try:
+        if not workers:
+            results = itertools.imap(_compress_file, jobs)
+        else:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap(_compress_file, jobs)
+
+        for (name, filepath, compress_type), compressed in \
+                itertools.izip(members, results):
+            _write_compressed(zf, name, filepath, compress_type, compressed)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def write_include_files(include_files, fileobj, location='.', hashes=None,
+                        manifest=None, workers=None, level=None,
+                        stored_extensions=STORED_EXTENSIONS):
+    """Writes the specified include_files as a zip archive into *fileobj*.
+
+    *fileobj* is either a path or a seekable file object. Unlike
+    pack_include_files(), the archive is never held in memory. Unpack the
+    files using extract_include_files().
+
+    If *hashes* is provided, only the files whose content has one of these
+    hashes are included. The hashes are taken from the *manifest* when
+    provided, see :class:`IncludeFilesCache`.
+
+    The files are compressed with the given zlib *level*, in a pool of
+    *workers* processes if provided. The files whose extension is in
+    *stored_extensions* are already compressed, and are stored as-is.
+    """
+    import zipfile
+
+    zf = zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_DEFLATED,
+                         allowZip64=True)
+    try:
+        _zip_include_files(zf, include_files, location, hashes, manifest,
+                           workers, level, stored_extensions)
+    finally:
+        zf.close()
+
+
+def pack_include_files(include_files, location='.', hashes=None,
+                       manifest=None, **options):
     """Package up the specified include_files into a zipfile data bundle.
 
     This is a convenience function for packaging up data files into a binary
     blob, that can then be shipped to the different agents.  Unpack the files
     using unpack_include_files().
+
+    The whole bundle is built in memory: for big files, use
+    pack_include_chunks() or write_include_files(), which also describes the
+    other options.
     """
-    file_data = StringIO()
-    zf = zipfile.ZipFile(file_data, "w", compression=zipfile.ZIP_DEFLATED)
-
-    def store_file(name, filepath):
-        info = zipfile.ZipInfo(name)
-        info.external_attr = os.stat(filepath).st_mode << 16L
-        with open(filepath) as f:
-            zf.writestr(info, f.read())
-
-    for basepath in glob(include_files, location):
-        basedir, basename = os.path.split(basepath)
-        if not os.path.isdir(basepath):
-            store_file(basename, basepath)
-        else:
-            for root, dirnames, filenames in os.walk(basepath):
-                for filename in filenames:
-                    filepath = os.path.join(root, filename)
-                    store_file(filepath[len(basedir):], filepath)
+    from StringIO import StringIO
 
-    zf.close()
+    file_data = StringIO()
+    write_include_files(include_files, file_data, location, hashes, manifest,
+                        **options)
     return file_data.getvalue().encode('base64')
 
 
+def pack_include_chunks(include_files, location='.', chunk_size=CHUNK_SIZE,
+                        hashes=None, manifest=None, **options):
+    """Package up the specified include_files, and yields the bundle by
+    chunks of *chunk_size* bytes.
+
+    The bundle is spooled in a temporary file, so its size is not bounded by
+    the memory. The chunks are raw bytes, they can be sent as ZMQ frames.
+    Unpack the files using unpack_include_chunks(). See
+    write_include_files() for the other options.
+    """
+    import tempfile
+
+    with tempfile.TemporaryFile() as f:
+        write_include_files(include_files, f, location, hashes, manifest,
+                            **options)
+        f.seek(0)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
 def maybe_makedirs(dirpath):
     """Like os.makedirs, but no error if the final directory exists."""
     if not os.path.isdir(dirpath):
         os.makedirs(dirpath)
 
 
-def unpack_include_files(file_data, location='.'):
+def _same_file(path, info):
+    # tells if the file at path has the size and the CRC of the zip member
+    try:
+        if os.stat(path).st_size != info.file_size:
+            return False
+        crc = 0
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+    except (IOError, OSError):
+        return False
+    return crc & 0xffffffff == info.CRC
+
+
+def _extract_member(zf, info, itempath, skip_unchanged):
+    import shutil
+
+    # streams a member to the disk, and returns the number of bytes written,
+    # or None if the file was skipped
+    if skip_unchanged and _same_file(itempath, info):
+        written = None
+    else:
+        source = zf.open(info)
+        try:
+            with open(itempath, "wb") as f:
+                shutil.copyfileobj(source, f, CHUNK_SIZE)
+        finally:
+            source.close()
+        written = info.file_size
+
+    mode = info.external_attr >> 16L
+    if mode:
+        os.chmod(itempath, mode)
+    return written
+
+
+def _member_name(name):
+    # the name of a member relative to the extraction directory. Names which
+    # would be written outside of it are rejected.
+    name = name.lstrip('/')
+    normalized = os.path.normpath(name)
+    if normalized == os.pardir or normalized.startswith(os.pardir + os.sep):
+        raise ValueError('Invalid path in the include files: %r' % name)
+    return name
+
+
+def extract_include_files(fileobj, location='.', manifest=None, cache=None,
+                          skip_unchanged=False, workers=None):
+    """Extract a zip archive of include_files into the specified directory.
+
+    *fileobj* is either a path or a seekable file object, in the format
+    produced by write_include_files(). The files are streamed to the disk.
+
+    If an :class:`IncludeFilesCache` is provided, the extracted files are
+    added to it, and the files of the *manifest* which are not in the
+    archive are restored from it.
+
+    If *skip_unchanged* is True, the files already on the disk with the
+    same size and CRC are not written again. If *workers* is provided, the
+    files are written by a pool of threads; this needs *fileobj* to be a
+    path or a StringIO, since each thread reads the archive on its own.
+
+    Returns a mapping with the number of **files** in the archive, the
+    number of **skipped** ones and the number of **bytes** written. Raises
+    ValueError if a file would be written outside of *location*.
+    """
+    from StringIO import StringIO
+    from multiprocessing.pool import ThreadPool
+    import zipfile
+
+    if isinstance(fileobj, basestring):
+        reopen = functools.partial(zipfile.ZipFile, fileobj)
+    elif hasattr(fileobj, 'getvalue'):
+        def reopen():
+            return zipfile.ZipFile(StringIO(fileobj.getvalue()))
+    else:
+        reopen = None
+
+    report = {'files': 0, 'skipped': 0, 'bytes': 0}
+    members = []
+    zf = zipfile.ZipFile(fileobj)
+    try:
+        # the directories are created first, so the members are independent
+        for info in zf.infolist():
+            itemname = _member_name(info.filename)
+            itempath = os.path.join(location, itemname)
+            if itemname.endswith("/"):
+                maybe_makedirs(itempath)
+            else:
+                maybe_makedirs(os.path.dirname(itempath))
+                members.append((itemname, itempath, info))
+
+        if not workers or reopen is None:
+            written = [_extract_member(zf, member[2], member[1],
+                                       skip_unchanged)
+                       for member in members]
+        else:
+            local = threading.local()
+            opened = []
+
+            def _extract(member):
+                if not hasattr(local, 'zf'):
+                    local.zf = reopen()
+                    opened.append(local.zf)
+                itemname, itempath, info = member
+                return _extract_member(local.zf, info, itempath,
+                                       skip_unchanged)
+
+            pool = ThreadPool(workers)
+            try:
+                written = pool.map(_extract, members)
+            finally:
+                pool.close()
+                pool.join()
+                for thread_zf in opened:
+                    thread_zf.close()
+    finally:
+        zf.close()
+
+    for (itemname, itempath, info), size in zip(members, written):
+        report['files'] += 1
+        if size is None:
+            report['skipped'] += 1
+        else:
+            report['bytes'] += size
+        if cache is not None:
+            hash = None
+            if manifest is not None and itemname in manifest:
+                hash = manifest[itemname][0]
+            cache.add(itempath, hash)
+
+    if manifest is not None and cache is not None:
+        extracted = set(member[0] for member in members)
+        for name, (hash, mode) in manifest.items():
+            if name not in extracted:
+                cache.restore(hash, os.path.join(location, _member_name(name)),
+                              mode)
+
+    return report
+
+
+def unpack_include_files(file_data, location='.', manifest=None, cache=None,
+                         **options):
     """Unpack a blob of include_files data into the specified directory.
 
     This is a convenience function for unpackaging data files from a binary
     blob, that can be used on the different agents.  It accepts data in the
-    format produced by pack_include_files().
+    format produced by pack_include_files(). See extract_include_files() for
+    the other options and the returned report.
     """
+    from StringIO import StringIO
+
     file_data = str(file_data).decode('base64')
-    zf = zipfile.ZipFile(StringIO(file_data))
+    return extract_include_files(StringIO(file_data), location, manifest,
+                                 cache, **options)
 
-    for itemname in zf.namelist():
-        itempath = os.path.join(location, itemname.lstrip("/"))
-        if itemname.endswith("/"):
-            maybe_makedirs(itempath)
-        else:
-            maybe_makedirs(os.path.dirname(itempath))
-            with open(itempath, "w") as f:
-                f.write(zf.read(itemname))
-            mode = zf.getinfo(itemname).external_attr >> 16L
-            if mode:
-                os.chmod(itempath, mode)
-    zf.close()
+
+def unpack_include_chunks(chunks, location='.', manifest=None, cache=None,
+                          **options):
+    """Unpack the include_files bundle made of the given chunks into the
+    specified directory.
+
+    It accepts any iterable of chunks, like the ones produced by
+    pack_include_chunks(). The chunks are spooled in a temporary file, so
+    the size of the bundle is not bounded by the memory. See
+    extract_include_files() for the other options and the returned report.
+    """
+    import tempfile
+
+    with tempfile.NamedTemporaryFile() as f:
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        return extract_include_files(f.name, location, manifest, cache,
+                                     **options)
@@ -0,0 +1,355 @@
+import collections
+import errno
+import itertools
+import os
+import signal
+import sys
+import traceback
+
+import zmq
+
+from loadsbase.clock import monotonic
+from loadsbase.codec import get_codec
+from loadsbase.stats import Timer
+from loadsbase.util import logger, null_streams, resolve_name
+
+
+# makes the default endpoints of the pools of a process unique
+_POOL_IDS = itertools.count()
+
+
+class WorkerError(Exception):
+    """Raised when a job fails, or when its worker dies."""
+
+
+class _Worker(object):
+    __slots__ = ('index', 'pid', 'spawned', 'ready', 'job')
+
+    def __init__(self, index, pid, spawned):
+        self.index = index
+        self.pid = pid
+        self.spawned = spawned
+        self.ready = False
+        self.job = None
+
+
+def _redirect_output(output):
+    # dup2 is enough: unlike spawning an interpreter with subprocess, the
+    # streams don't go through a pipe
+    if output is None:
+        null_streams([sys.stdout, sys.stderr])
+        return
+    sys.stdout.flush()
+    sys.stderr.flush()
+    fd = os.open(output, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.dup2(fd, sys.stdout.fileno())
+        os.dup2(fd, sys.stderr.fileno())
+    finally:
+        os.close(fd)
+
+
+def _worker_loop(endpoint, parent, codec, poll_interval):
+    # runs the jobs sent by the pool until it says to stop, or dies
+    context = zmq.Context()
+    socket = context.socket(zmq.DEALER)
+    socket.identity = str(os.getpid())
+    socket.linger = 1000
+    socket.connect(endpoint)
+    socket.send_multipart(['READY'])
+    try:
+        while True:
+            if not socket.poll(poll_interval * 1000):
+                if os.getppid() != parent:
+                    return      # orphaned
+                continue
+
+            frames = socket.recv_multipart()
+            if frames[0] == 'STOP':
+                return
+
+            job_id, payload = frames[1:]
+            try:
+                target, args = codec.decode(payload)
+                result = codec.encode(resolve_name(target)(*args))
+            except Exception:
+                reply = ['ERROR', job_id, traceback.format_exc()]
+            else:
+                reply = ['DONE', job_id, result]
+            socket.send_multipart(reply)
+    finally:
+        socket.close()
+        context.term()
+
+
+class WorkerPool(object):
+    """A pool of pre-forked worker processes, which run jobs sent over ZMQ.
+
+    Workers are forked from the current process, so the modules it already
+    imported, like the ones listed in *preload*, don't need to be imported
+    again and a worker is ready in a few milliseconds. Their standard output
+    and error are redirected to *output*.
+
+    There is no separate fork server: the workers which replace the dead
+    ones are forked from the process driving the pool as well, in the state
+    it is in at that time. Only the forking thread survives in a worker, so
+    the locks held by the other threads stay locked there, and an IO loop
+    or ZMQ sockets inherited from the parent must not be used. Create and
+    start the pool before starting threads or an IO loop when possible.
+
+    A job is the name of a callable, resolved with
+    :func:`loadsbase.util.resolve_name` in the worker, and its arguments.
+    The arguments and the result are serialized with the *codec*.
+
+    The pool is driven by the process which created it: :meth:`poll` sends
+    the pending jobs to the idle workers, collects the results and restarts
+    the workers which died, with their job reported as failed.
+
+    The time between the fork of a worker and its first message is recorded
+    in **spawn_timer**, see :meth:`stats`.
+
+    Options:
+
+    - **size**: the number of workers. Defaults to 4.
+    - **endpoint**: the ZMQ endpoint the workers connect to. Defaults to an
+      ipc endpoint specific to the pool. The file of an ipc endpoint is
+      removed by :meth:`stop`.
+    - **preload**: names of modules to import before forking.
+    - **output**: the path of a file the output of the workers is appended
+      to. Defaults to None, which discards it.
+    - **codec**: the name of the codec of the jobs and results. Defaults to
+      'json'.
+    - **poll_interval**: how often an idle worker checks its parent is
+      still alive, in seconds. Defaults to 1.
+    """
+    def __init__(self, size=4, endpoint=None, preload=(), output=None,
+                 codec='json', poll_interval=1.):
+        if endpoint is None:
+            endpoint = 'ipc:///tmp/loads-workers-%d-%d.ipc' % (
+                os.getpid(), next(_POOL_IDS))
+        self.size = size
+        self.endpoint = endpoint
+        self.preload = preload
+        self.output = output
+        self.codec = get_codec(codec)
+        self.poll_interval = poll_interval
+        self.spawn_timer = Timer('spawn')
+        self.spawned = self.restarts = 0
+        self.running = False
+        self._workers = {}
+        self._idle = collections.deque()
+        self._jobs = collections.deque()
+        self._results = collections.deque()
+        self._job_ids = itertools.count()
+        self._context = self._socket = None
+
+    def __len__(self):
+        return len(self._workers)
+
+    def start(self, timeout=10.):
+        """Forks the workers and waits until they are all ready."""
+        for name in self.preload:
+            resolve_name(name)
+
+        self._context = zmq.Context()
+        self._socket = self._context.socket(zmq.ROUTER)
+        self._socket.linger = 0
+        self._socket.bind(self.endpoint)
+        self.running = True
+
+        for index in range(self.size):
+            self._spawn(index)
+
+        deadline = monotonic() + timeout
+        while len(self._idle) < self.size:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                self.stop()
+                raise WorkerError('The workers did not start in %ss' % timeout)
+            self.poll(remaining)
+
+    def _spawn(self, index):
+        spawned = monotonic()
+        parent = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                _redirect_output(self.output)
+                _worker_loop(self.endpoint, parent, self.codec,
+                             self.poll_interval)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                # the handlers of the parent must not run here
+                os._exit(status)
+
+        self.spawned += 1
+        self._workers[str(pid)] = _Worker(index, pid, spawned)
+
+    def submit(self, target, *args):
+        """Queues a job calling *target* with *args*. Returns its id."""
+        job_id = str(next(self._job_ids))
+        self._jobs.append((job_id, self.codec.encode([target, args])))
+        return job_id
+
+    def _dispatch(self):
+        while self._jobs and self._idle:
+            identity = self._idle.popleft()
+            worker = self._workers.get(identity)
+            if worker is None:
+                continue
+            job_id, payload = self._jobs.popleft()
+            worker.job = job_id
+            self._socket.send_multipart([identity, 'JOB', job_id, payload])
+
+    def _reap(self):
+        for identity, worker in self._workers.items():
+            try:
+                pid, status = os.waitpid(worker.pid, os.WNOHANG)
+            except OSError, exc:
+                if exc.errno != errno.ECHILD:
+                    raise
+                pid, status = worker.pid, 0
+            if pid == 0:
+                continue
+
+            del self._workers[identity]
+            logger.debug('Worker %d died with status %d' % (worker.pid,
+                                                            status))
+            if worker.job is not None:
+                self._results.append((worker.job, False,
+                                      'The worker died with status %d'
+                                      % status))
+            if self.running:
+                self.restarts += 1
+                self._spawn(worker.index)
+
+    def poll(self, timeout=0.):
+        """Dispatches the jobs, waits at most *timeout* seconds for messages
+        from the workers, and restarts the dead workers.
+
+        Returns the list of the (job id, success, result) tuples received,
+        which may be empty. When a job failed, the result is the error
+        message.
+        """
+        self._reap()
+        self._dispatch()
+
+        deadline = monotonic() + timeout
+        while not self._results:
+            remaining = max(deadline - monotonic(), 0)
+            # wakes up regularly, to notice the dead workers
+            if self._socket.poll(min(remaining, 0.1) * 1000):
+                self._receive()
+                self._dispatch()
+                break
+            self._reap()
+            self._dispatch()
+            if remaining == 0:
+                break
+
+        results = list(self._results)
+        self._results.clear()
+        return results
+
+    def _receive(self):
+        while True:
+            try:
+                frames = self._socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            identity, kind = frames[:2]
+            worker = self._workers.get(identity)
+            if worker is None:
+                continue
+
+            if kind == 'READY':
+                worker.ready = True
+                self.spawn_timer.record(monotonic() - worker.spawned)
+            else:
+                job_id, result = frames[2:]
+                worker.job = None
+                if kind == 'DONE':
+                    self._results.append((job_id, True,
+                                          self.codec.decode(result)))
+                else:
+                    self._results.append((job_id, False, result))
+            self._idle.append(identity)
+
+    def map(self, target, args_list, timeout=None):
+        """Runs *target* once for each tuple of arguments in *args_list*, and
+        returns the list of the results.
+
+        Raises :class:`WorkerError` if a job fails, or if the results are
+        not there after *timeout* seconds.
+        """
+        job_ids = [self.submit(target, *args) for args in args_list]
+        pending = set(job_ids)
+        results = {}
+        others = []
+        deadline = None if timeout is None else monotonic() + timeout
+
+        try:
+            while pending:
+                if deadline is None:
+                    wait = 1.
+                else:
+                    wait = deadline - monotonic()
+                    if wait <= 0:
+                        raise WorkerError('Timed out')
+                for job_id, success, result in self.poll(wait):
+                    if job_id not in pending:
+                        # the result of a job submitted by someone else
+                        others.append((job_id, success, result))
+                        continue
+                    if not success:
+                        raise WorkerError(result)
+                    pending.remove(job_id)
+                    results[job_id] = result
+        finally:
+            self._results.extend(others)
+
+        return [results[job_id] for job_id in job_ids]
+
+    def stats(self):
+        """Returns the number of **workers**, of **spawned** processes,
+        of **restarts** and the **spawn_latency** snapshot, in seconds."""
+        return {'workers': len(self), 'spawned': self.spawned,
+                'restarts': self.restarts,
+                'spawn_latency': self.spawn_timer.snapshot()}
+
+    def stop(self, timeout=5.):
+        """Stops the workers, killing the ones still running after
+        *timeout* seconds."""
+        self.running = False
+        if self._socket is None:
+            return
+
+        for identity in self._workers:
+            self._socket.send_multipart([identity, 'STOP'])
+
+        deadline = monotonic() + timeout
+        while self._workers and monotonic() < deadline:
+            self._reap()
+            if self._workers:
+                self._socket.poll(50)
+
+        for worker in self._workers.values():
+            try:
+                os.kill(worker.pid, signal.SIGKILL)
+                os.waitpid(worker.pid, 0)
+            except OSError:
+                pass
+
+        self._workers.clear()
+        self._idle.clear()
+        self._socket.close()
+        self._context.term()
+        self._socket = self._context = None
+        if self.endpoint.startswith('ipc://'):
+            try:
+                os.remove(self.endpoint[len('ipc://'):])
+            except OSError:
+                pass